@@ -0,0 +1,385 @@
+# Benchmarks of the trimming pipeline on synthetic models
+
+import numpy as np
+import argparse
+import json
+import generate_scene
+import tracemalloc
+import subprocess
+import platform
+import tempfile
+import time
+import trim
+import sys
+import os
+
+# OCCT modules imported on demand by each stage of trim.py (see benchmark_startup)
+STARTUP_STAGES = \
+{
+    'trimming': ('OCC.Core.BRepPrimAPI', 'OCC.Core.BRepOffsetAPI', 'OCC.Core.GC'),
+    'booleans': ('OCC.Core.BRepAlgoAPI', 'OCC.Core.TopTools'),
+    'step_export': ('OCC.Core.STEPControl',),
+    'stl_export': ('OCC.Core.BRepMesh', 'OCC.Core.StlAPI'),
+    'curve_display': ('OCC.Core.GeomAPI', 'OCC.Core.GeomAbs', 'OCC.Core.TColgp'),
+}
+STAGES = ('load', 'find_start_end_of_curve', 'classification', 'topology', 'trim', 'trim_collect_shapes_that_are_in_the_same_plane', 'fusion', 'step_export', 'stl_export')
+
+# ===================================================
+# Benchmarks
+# ===================================================
+
+def benchmark_classification(sizes, points_per_unit_length, repeats):
+    results = []
+    for number_of_cylinders in sizes:
+        edges, primitives = generate_scene.make_drilled_box(number_of_cylinders, points_per_unit_length)
+        primitives_as_object = trim.collect_primitives_as_objects(primitives)
+        curves_as_object = trim.collect_curves_as_objects(edges)
+        timings = {'dense': [], 'grid_build': [], 'grid': []}
+        for _ in range(repeats):
+            start = time.perf_counter()
+            trim.find_primitives_for_curves(curves_as_object, primitives_as_object)
+            timings['dense'].append(time.perf_counter() - start)
+            dense_primitives = [curve.primitives for curve in curves_as_object]
+            start = time.perf_counter()
+            points, _ = trim.collect_curves_points_as_array(curves_as_object)
+            grid = trim.build_primitive_grid(primitives_as_object, points)
+            timings['grid_build'].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            trim.find_primitives_for_curves(curves_as_object, primitives_as_object, grid=grid)
+            timings['grid'].append(time.perf_counter() - start)
+            if dense_primitives != [curve.primitives for curve in curves_as_object]:
+                print("Grid classification differs from dense classification for", number_of_cylinders, "cylinders")
+        result = {'primitives': len(primitives), 'curves': len(edges['curves'])}
+        result.update({name: min(values) for name, values in timings.items()})
+        result['grid_total'] = result['grid_build'] + result['grid']
+        results.append(result)
+        print(f"primitives {result['primitives']:6d} curves {result['curves']:6d} dense {result['dense']:9.4f}s grid build {result['grid_build']:9.4f}s grid {result['grid']:9.4f}s")
+    if len(results) > 1:
+        x = np.log([result['primitives'] for result in results])
+        for name in ('dense', 'grid_total'):
+            slope = np.polyfit(x, np.log([result[name] for result in results]), 1)[0]
+            print(f"{name} scales as primitives^{slope:.2f}")
+    return results
+
+def benchmark_fusion(sizes, strategies):
+    # Row of partially overlapping cylinders, as the holes of a part after trimming
+    results = []
+    for number_of_shapes in sizes:
+        shapes = [trim.make_cylinder_OCCT(0.6, 1.0, [float(index), 0.0, 0.0], [0.0, 0.0, 1.0]) for index in range(number_of_shapes)]
+        result = {'shapes': number_of_shapes}
+        for strategy in strategies:
+            start = time.perf_counter()
+            trim.fuse_shapes_OCCT(shapes, strategy)
+            result[strategy] = time.perf_counter() - start
+        results.append(result)
+        print(f"shapes {number_of_shapes:6d} " + " ".join(f"{strategy} {result[strategy]:9.4f}s" for strategy in strategies))
+    return results
+
+def time_stage(timings, stage, function, *arguments):
+    start = time.perf_counter()
+    result = function(*arguments)
+    timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+    return result
+
+def benchmark_stages(sizes, points_per_unit_length, noise, fuse_strategy):
+    # Same stages as trim_object, timed one by one on synthetic drilled boxes
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for number_of_cylinders in sizes:
+            model_directory = os.path.join(directory, str(number_of_cylinders))
+            edges, primitives = generate_scene.make_drilled_box(number_of_cylinders, points_per_unit_length, noise)
+            surfaces_file, curves_file = generate_scene.write_scene(model_directory, edges, primitives)
+            timings = {}
+            edges, primitives = time_stage(timings, 'load', trim.read_data, surfaces_file, curves_file)
+            primitives_as_object = trim.collect_primitives_as_objects(primitives)
+            curves_as_object = trim.collect_curves_as_objects(edges)
+            for curve in curves_as_object:
+                time_stage(timings, 'find_start_end_of_curve', trim.find_start_end_of_curve, curve)
+            time_stage(timings, 'classification', trim.find_primitives_for_curves, curves_as_object, primitives_as_object)
+            topology = time_stage(timings, 'topology', trim.build_topology_index, curves_as_object, primitives_as_object, edges['corners'])
+            trimmed_shapes = []
+            for curve in curves_as_object:
+                trimmed_shapes.append(time_stage(timings, 'trim', trim.trim, curve, primitives_as_object) if len(curve.primitives) != 0 else None)
+            cube_planes = []
+            for _, face_loop in topology.face_loops:
+                trim_in_same_plane, _ = time_stage(timings, 'trim_collect_shapes_that_are_in_the_same_plane', trim.trim_collect_shapes_that_are_in_the_same_plane, [trimmed_shapes[curve_index] for curve_index in face_loop])
+                cube_planes.append(time_stage(timings, 'fusion', trim.fuse_shapes_OCCT, trim_in_same_plane, fuse_strategy))
+            cube = time_stage(timings, 'fusion', trim.fuse_shapes_OCCT, cube_planes, fuse_strategy)
+            cylinders = time_stage(timings, 'fusion', trim.fuse_shapes_OCCT, [shape for index, shape in enumerate(trimmed_shapes) if index not in topology.face_loop_curves], fuse_strategy)
+            builder = trim.BRep_Builder()
+            compound = trim.TopoDS_Compound()
+            builder.MakeCompound(compound)
+            builder.Add(compound, cube)
+            builder.Add(compound, cylinders)
+            time_stage(timings, 'step_export', trim.save_to_step, compound, os.path.join(model_directory, "trimmed.step"))
+            time_stage(timings, 'stl_export', trim.save_to_stl, compound, os.path.join(model_directory, "trimmed.stl"), trim.STL_LEVEL_OF_DETAIL, trim.STL_FORMAT, [('cube', cube), ('cylinders', cylinders)])
+            result = {'cylinders': number_of_cylinders, 'primitives': len(primitives), 'curves': len(edges['curves']), 'points': sum(len(curve.points) for curve in curves_as_object)}
+            result.update(timings)
+            results.append(result)
+            print(f"cylinders {number_of_cylinders:6d} " + " ".join(f"{stage} {seconds:.4f}s" for stage, seconds in timings.items()))
+    return results
+
+def compare_stages(results, previous_file):
+    # Ratio current / previous of every stage for the sizes present in both runs
+    with open(previous_file) as file:
+        previous_results = {result['cylinders']: result for result in json.load(file)['results']}
+    for result in results:
+        previous_result = previous_results.get(result['cylinders'])
+        if previous_result is None:
+            continue
+        ratios = [f"{stage} x{result[stage] / previous_result[stage]:.2f}" for stage in STAGES if previous_result.get(stage, 0.0) > 0.0]
+        print(f"cylinders {result['cylinders']:6d} " + " ".join(ratios))
+
+def describe_environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+class DictBackedCurve:
+    # Representation of a curve before the slots and arrays of trim.Curve, kept as baseline of the memory benchmark
+    def __init__(self):
+        self.primitives = []
+        self.start_end = []
+        self.points = None
+        self.lines = None
+        self.index = -1
+
+def measure_allocated_bytes(build):
+    tracemalloc.start()
+    built = build()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return allocated, built
+
+def benchmark_memory(number_of_curves, points_per_curve):
+    generator = np.random.default_rng(0)
+    points = generator.random((number_of_curves, points_per_curve, 3))
+    lines = np.stack([np.arange(points_per_curve - 1), np.arange(1, points_per_curve)], axis=1)
+    def build_dict_backed_curves():
+        curves = []
+        for curve_index in range(number_of_curves):
+            curve = DictBackedCurve()
+            curve.points = points[curve_index].tolist()
+            curve.lines = lines.tolist()
+            curve.index = curve_index
+            curve.primitives = [0, 1]
+            curves.append(curve)
+        return curves
+    def build_curves():
+        curves = []
+        for curve_index in range(number_of_curves):
+            curve = trim.Curve()
+            curve.points = np.array(points[curve_index])
+            curve.lines = lines.astype(np.int32)
+            curve.index = curve_index
+            curve.primitives = [0, 1]
+            curves.append(curve)
+        return curves
+    results = {'curves': number_of_curves, 'points_per_curve': points_per_curve}
+    for name, build in (('before', build_dict_backed_curves), ('after', build_curves)):
+        allocated, built = measure_allocated_bytes(build)
+        del built
+        results[name] = allocated / number_of_curves
+        print(f"{name:6s} {results[name]:10.1f} bytes per curve")
+    print(f"ratio  {results['before'] / results['after']:10.2f}")
+    return results
+
+def parse_import_times(output):
+    # Lines of python -X importtime: "import time: self [us] | cumulative | imported package", nesting is the indentation of the package
+    import_times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_time, cumulative_time, module = line[len('import time:'):].split('|')
+        import_times[module.strip()] = (int(self_time) * 1e-6, int(cumulative_time) * 1e-6)
+    return import_times
+
+def benchmark_startup(repeats):
+    # Cold start of a process importing trim, then the import time of the OCCT modules each stage loads on demand
+    directory = os.path.dirname(os.path.abspath(__file__))
+    wall_times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import trim'], check=True, cwd=directory)
+        wall_times.append(time.perf_counter() - start)
+    statements = ['import trim'] + [f'import {module}' for modules in STARTUP_STAGES.values() for module in modules]
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', '\n'.join(statements)], capture_output=True, text=True, check=True, cwd=directory)
+    import_times = parse_import_times(completed.stderr)
+    result = {'wall': min(wall_times), 'trim': import_times['trim'][1], 'stages': {}}
+    for stage, modules in STARTUP_STAGES.items():
+        result['stages'][stage] = sum(import_times[module][1] for module in modules if module in import_times)
+    slowest_modules = sorted(import_times.items(), key=lambda item: item[1][0], reverse=True)[:15]
+    result['slowest_modules'] = {module: self_time for module, (self_time, _) in slowest_modules}
+    print(f"{'process start and import trim':40s} {result['wall'] * 1e3:9.1f} ms")
+    print(f"{'import trim':40s} {result['trim'] * 1e3:9.1f} ms")
+    for stage, seconds in result['stages'].items():
+        print(f"{'  deferred to ' + stage:40s} {seconds * 1e3:9.1f} ms")
+    deferred = sum(result['stages'].values())
+    print(f"{'  deferred in total':40s} {deferred * 1e3:9.1f} ms ({100.0 * deferred / (deferred + result['trim']):.0f}% of an eager import)")
+    print("Slowest modules (self time)")
+    for module, self_time in result['slowest_modules'].items():
+        print(f"  {module:38s} {self_time * 1e3:9.1f} ms")
+    return result
+
+# ===================================================
+# Regression checks
+# ===================================================
+
+def classify_curves_one_by_one(curves : list, primitives : list):
+    # Classification of the original pipeline, a single point of every curve tested against every primitive
+    for curve in curves:
+        curve.primitives = []
+        trim.find_start_end_of_curve(curve)
+        trim.find_primitives_for_curve(curve, primitives)
+    return [curve.primitives for curve in curves]
+
+def collect_face_loops(topology):
+    return sorted((plane_index, sorted(face_loop)) for plane_index, face_loop in topology.face_loops)
+
+def check_classification(sizes, noises, seeds):
+    # On a noisy model the batch classification (dense and grid) has to give the lists of the original classification of the same
+    # model without noise, the original single point test being exact there, and the same face loops
+    failures = []
+    for number_of_cylinders in sizes:
+        for seed in seeds:
+            reference_edges, reference_primitives = generate_scene.make_drilled_box(number_of_cylinders, noise=0.0, seed=seed)
+            reference_curves = trim.collect_curves_as_objects(reference_edges)
+            reference_primitives_as_object = trim.collect_primitives_as_objects(reference_primitives)
+            expected_primitives = classify_curves_one_by_one(reference_curves, reference_primitives_as_object)
+            expected_face_loops = collect_face_loops(trim.build_topology_index(reference_curves, reference_primitives_as_object, reference_edges['corners']))
+            for noise in noises:
+                edges, primitives = generate_scene.make_drilled_box(number_of_cylinders, noise=noise, seed=seed)
+                primitives_as_object = trim.collect_primitives_as_objects(primitives)
+                for classifier in ('dense', 'grid'):
+                    curves_as_object = trim.collect_curves_as_objects(edges)
+                    grid = None
+                    if classifier == 'grid':
+                        points, _ = trim.collect_curves_points_as_array(curves_as_object)
+                        grid = trim.build_primitive_grid(primitives_as_object, points)
+                    trim.find_primitives_for_curves(curves_as_object, primitives_as_object, grid=grid)
+                    face_loops = collect_face_loops(trim.build_topology_index(curves_as_object, primitives_as_object, edges['corners']))
+                    different_curves = [curve.index for curve, primitives in zip(curves_as_object, expected_primitives) if curve.primitives != primitives]
+                    is_passed = (len(different_curves) == 0 and face_loops == expected_face_loops)
+                    print(f"cylinders {number_of_cylinders:5d} seed {seed:3d} noise {noise:8.1e} {classifier:5s} curves differing {len(different_curves):4d} face loops {len(face_loops):3d} {'ok' if is_passed else 'FAILED'}")
+                    if not is_passed:
+                        failures.append({'cylinders': number_of_cylinders, 'seed': seed, 'noise': noise, 'classifier': classifier, 'curves': different_curves, 'face_loops': len(face_loops)})
+    return failures
+
+def check_plane_clustering():
+    # Opposite-facing normals of the same plane, including diagonal normals whose largest component is ambiguous, have to be one cluster
+    cases = \
+    {
+        'axis': [((0.0, 0.0, 1.0), 0.5), ((0.0, 0.0, -1.0), -0.5)],
+        'diagonal': [((0.70711, -0.70710, 0.0), 0.5), ((-0.70710, 0.70711, 0.0), -0.5)],
+        'diagonal with a parallel plane': [((0.70711, -0.70710, 0.0), 0.5), ((-0.70710, 0.70711, 0.0), -0.5), ((0.70711, -0.70710, 0.0), 0.7)],
+        'three-way diagonal': [((0.57735, 0.57735, -0.57736), 1.0), ((-0.57736, -0.57735, 0.57735), -1.0)],
+    }
+    failures = []
+    for name, planes in cases.items():
+        planar_faces = []
+        for normal, distance_to_origin in planes:
+            planar_face = trim.PlanarFace()
+            planar_face.normal = normal
+            planar_face.distance_to_origin = distance_to_origin
+            planar_faces.append(planar_face)
+        expected_clusters = len({distance_to_origin for _, distance_to_origin in planes if distance_to_origin > 0.0})
+        clusters = trim.cluster_planar_faces(planar_faces)
+        is_passed = (len(clusters) == expected_clusters)
+        print(f"plane clustering {name}: {len(planes)} planes -> {len(clusters)} clusters {'ok' if is_passed else 'FAILED'}")
+        if not is_passed:
+            failures.append({'plane_clustering': name, 'clusters': len(clusters)})
+    return failures
+
+def describe_classification(curves_as_object, topology):
+    # Primitives of every curve and face loops by index of the curve in topo.json
+    return {curve.index: curve.primitives for curve in curves_as_object}, sorted((plane_index, sorted(curves_as_object[curve_index].index for curve_index in face_loop)) for plane_index, face_loop in topology.face_loops)
+
+def check_welding(surfaces_file, curves_file, tolerance):
+    # Welding the model, or the model with a duplicate of every curve, has to keep its curves, their indices, classification and face loops
+    edges, primitives = trim.read_data(surfaces_file, curves_file)
+    curves_as_object, _, topology = trim.classify_curves_and_build_topology(edges, primitives)
+    expected = describe_classification(curves_as_object, topology)
+    duplicated_edges = dict(edges)
+    duplicated_edges['curves'] = edges['curves'] + [dict(curve) for curve in edges['curves']]
+    failures = []
+    for name, model_edges in (('model', edges), ('model with duplicated curves', duplicated_edges)):
+        welded_curves_as_object, _, welded_topology = trim.classify_curves_and_build_topology(trim.weld_curves(model_edges, tolerance), primitives)
+        is_passed = (describe_classification(welded_curves_as_object, welded_topology) == expected)
+        print(f"welding {name}: {len(model_edges['curves'])} -> {len(welded_curves_as_object)} curves, {len(welded_topology.face_loops)} face loops {'ok' if is_passed else 'FAILED'}")
+        if not is_passed:
+            failures.append({'welding': name, 'curves': len(welded_curves_as_object), 'face_loops': len(welded_topology.face_loops)})
+    return failures
+
+def check_weld_displacement(surfaces_file, curves_file, tolerances):
+    # Every point of a kept curve has to be within tolerance of a welded point of that curve, whatever the sampling density
+    edges, _ = trim.read_data(surfaces_file, curves_file)
+    failures = []
+    for tolerance in tolerances:
+        maximum_displacement = 0.0
+        for welded_curve in trim.weld_curves(edges, tolerance)['curves']:
+            points = np.asarray(edges['curves'][welded_curve['index']]['pv_points'], dtype=np.float64).reshape(-1, 3)
+            distances = np.linalg.norm(points[:, None, :] - welded_curve['pv_points'][None, :, :], axis=2)
+            maximum_displacement = max(maximum_displacement, distances.min(axis=1).max())
+        is_passed = (maximum_displacement <= tolerance * (1.0 + 1e-9))
+        print(f"welding tolerance {tolerance:8.1e}: maximum displacement {maximum_displacement:8.1e} {'ok' if is_passed else 'FAILED'}")
+        if not is_passed:
+            failures.append({'weld_tolerance': tolerance, 'maximum_displacement': maximum_displacement})
+    return failures
+
+# ===================================================
+# Entry point
+# ===================================================
+
+if __name__ == '__main__':
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--output', default=None, help="JSON file with the results")
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    classification = subparsers.add_parser('classification', parents=[common], help="curve to primitive classification, dense versus spatial grid")
+    classification.add_argument('--sizes', type=int, nargs='+', default=[16, 64, 256, 1024, 4096], help="number of cylinders of the synthetic models")
+    classification.add_argument('--points-per-unit-length', type=float, default=200.0)
+    classification.add_argument('--repeats', type=int, default=3)
+    fusion = subparsers.add_parser('fusion', parents=[common], help="fusion of lists of shapes with every fuse strategy")
+    fusion.add_argument('--sizes', type=int, nargs='+', default=[8, 16, 32, 64, 128])
+    fusion.add_argument('--strategies', nargs='+', default=list(trim.FUSE_STRATEGIES), choices=trim.FUSE_STRATEGIES)
+    stages = subparsers.add_parser('stages', parents=[common], help="time of every stage of the pipeline on synthetic drilled boxes")
+    stages.add_argument('--sizes', type=int, nargs='+', default=[8, 32, 128], help="number of cylinders of the synthetic models")
+    stages.add_argument('--points-per-unit-length', type=float, default=200.0)
+    stages.add_argument('--noise', type=float, default=1e-5)
+    stages.add_argument('--fuse-strategy', default=trim.FUSE_STRATEGY, choices=trim.FUSE_STRATEGIES)
+    stages.add_argument('--compare', default=None, help="results of a previous run (--output) to compare against")
+    memory = subparsers.add_parser('memory', parents=[common], help="bytes per curve of the curve representation")
+    memory.add_argument('--curves', type=int, default=100000)
+    memory.add_argument('--points-per-curve', type=int, default=32)
+    startup = subparsers.add_parser('startup', parents=[common], help="import time of trim and of the OCCT modules loaded on demand by each stage")
+    startup.add_argument('--repeats', type=int, default=5)
+    check = subparsers.add_parser('check', parents=[common], help="regression checks of the batch stages against the original pipeline, exits with 1 on failure")
+    check.add_argument('--sizes', type=int, nargs='+', default=[16, 64])
+    check.add_argument('--noises', type=float, nargs='+', default=[0.0, 1e-5, 1e-4, 5e-4], help="standard deviations of the noise of the points")
+    check.add_argument('--seeds', type=int, nargs='+', default=[0, 1, 2])
+    check.add_argument('--surfaces', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "input_data", "surface_info.json"), help="model of the welding check")
+    check.add_argument('--curves', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "input_data", "topo.json"))
+    check.add_argument('--weld-tolerance', type=float, default=trim.WELD_TOLERANCE)
+    check.add_argument('--weld-displacement-tolerances', type=float, nargs='+', default=[trim.WELD_TOLERANCE, 2e-3, 3e-3, 5e-3], help="tolerances of the welding displacement check")
+    arguments = parser.parse_args()
+    if arguments.benchmark == 'classification':
+        results = benchmark_classification(arguments.sizes, arguments.points_per_unit_length, arguments.repeats)
+    elif arguments.benchmark == 'fusion':
+        results = benchmark_fusion(arguments.sizes, arguments.strategies)
+    elif arguments.benchmark == 'stages':
+        results = benchmark_stages(arguments.sizes, arguments.points_per_unit_length, arguments.noise, arguments.fuse_strategy)
+        if arguments.compare is not None:
+            compare_stages(results, arguments.compare)
+    elif arguments.benchmark == 'memory':
+        results = benchmark_memory(arguments.curves, arguments.points_per_curve)
+    elif arguments.benchmark == 'startup':
+        results = benchmark_startup(arguments.repeats)
+    elif arguments.benchmark == 'check':
+        results = check_classification(arguments.sizes, arguments.noises, arguments.seeds) + check_plane_clustering() + check_welding(arguments.surfaces, arguments.curves, arguments.weld_tolerance) + check_weld_displacement(arguments.surfaces, arguments.curves, arguments.weld_displacement_tolerances)
+    if arguments.output is not None:
+        with open(arguments.output, 'w') as file:
+            json.dump({'benchmark': arguments.benchmark, 'environment': describe_environment(), 'results': results}, file, indent=4)
+    if arguments.benchmark == 'check' and len(results) > 0:
+        sys.exit(1)
@@ -0,0 +1,96 @@
+# Generator of synthetic models (surface_info.json and topo.json) to benchmark the trimming pipeline
+
+import numpy as np
+import argparse
+import json
+import os
+
+# Pairs of faces of the box joined by an edge
+BOX_EDGES = \
+[
+    ('front', 'top'), ('front', 'bottom'), ('front', 'right'), ('front', 'left'),
+    ('back', 'top'), ('back', 'bottom'), ('back', 'right'), ('back', 'left'),
+    ('top', 'right'), ('top', 'left'), ('bottom', 'right'), ('bottom', 'left'),
+]
+
+def make_polyline_curve(points, closed, noise, generator):
+    points = points + generator.normal(0.0, noise, points.shape)
+    number_of_points = len(points)
+    number_of_lines = number_of_points if closed else number_of_points - 1
+    lines = [[index, (index + 1) % number_of_points] for index in range(number_of_lines)]
+    return {'pv_points': points.tolist(), 'pv_lines': lines}
+
+def make_circle_curve(center, radius, number_of_points, noise, generator):
+    angles = np.linspace(0.0, 2.0 * np.pi, number_of_points, endpoint=False)
+    points = np.zeros((number_of_points, 3))
+    points[:, 0] = center[0] + radius * np.cos(angles)
+    points[:, 1] = center[1] + radius * np.sin(angles)
+    points[:, 2] = center[2]
+    return make_polyline_curve(points, True, noise, generator)
+
+def make_segment_curve(start, end, number_of_points, noise, generator):
+    weights = np.linspace(0.0, 1.0, number_of_points)[:, None]
+    points = (1.0 - weights) * np.asarray(start) + weights * np.asarray(end)
+    return make_polyline_curve(points, False, noise, generator)
+
+def make_drilled_box(number_of_cylinders, points_per_unit_length = 200.0, noise = 1e-5, depth = 0.2, seed = 0):
+    # Box [0, 1] x [0, 1] x [0, depth] with cylinders drilled along z on a jittered grid
+    # The err of every primitive is the standard deviation of the noise added to the points
+    generator = np.random.default_rng(seed)
+    primitives = []
+    def add_primitive(primitive_type, params):
+        primitives.append({'id': len(primitives), 'type': primitive_type, 'params': params, 'err': noise})
+    planes = \
+    {
+        'front': ([0.0, 0.0, 1.0], 0.0),
+        'back': ([0.0, 0.0, 1.0], depth),
+        'bottom': ([0.0, 1.0, 0.0], 0.0),
+        'top': ([0.0, 1.0, 0.0], 1.0),
+        'left': ([1.0, 0.0, 0.0], 0.0),
+        'right': ([1.0, 0.0, 0.0], 1.0),
+    }
+    for normal, distance in planes.values():
+        add_primitive('plane', [[normal], distance])
+    corners = np.array([[x, y, z] for z in (0.0, depth) for y in (0.0, 1.0) for x in (0.0, 1.0)])
+    curves = []
+    for face1, face2 in BOX_EDGES:
+        normal1, distance1 = planes[face1]
+        normal2, distance2 = planes[face2]
+        on_edge = np.array([np.allclose(np.dot(corner, normal1), distance1) and np.allclose(np.dot(corner, normal2), distance2) for corner in corners])
+        start, end = corners[on_edge]
+        number_of_points = max(2, int(np.linalg.norm(end - start) * points_per_unit_length))
+        curves.append(make_segment_curve(start, end, number_of_points, noise, generator))
+    cylinders_per_side = int(np.ceil(np.sqrt(number_of_cylinders)))
+    pitch = 1.0 / cylinders_per_side
+    for cylinder_index in range(number_of_cylinders):
+        i, j = divmod(cylinder_index, cylinders_per_side)
+        radius = pitch * generator.uniform(0.15, 0.3)
+        jitter = generator.uniform(-1.0, 1.0, 2) * (0.5 * pitch - radius) * 0.5
+        center = [(i + 0.5) * pitch + jitter[0], (j + 0.5) * pitch + jitter[1], 0.5 * depth]
+        add_primitive('cylinder', [[0.0, 0.0, 1.0], center, radius])
+        number_of_points = max(8, int(2.0 * np.pi * radius * points_per_unit_length))
+        for z in (0.0, depth):
+            curves.append(make_circle_curve([center[0], center[1], z], radius, number_of_points, noise, generator))
+    return {'curves': curves, 'corners': corners.tolist()}, primitives
+
+def write_scene(directory, edges, primitives):
+    os.makedirs(directory, exist_ok=True)
+    surfaces_file = os.path.join(directory, "surface_info.json")
+    curves_file = os.path.join(directory, "topo.json")
+    with open(surfaces_file, 'w') as file:
+        json.dump(primitives, file)
+    with open(curves_file, 'w') as file:
+        json.dump(edges, file)
+    return surfaces_file, curves_file
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', help="directory where surface_info.json and topo.json are written")
+    parser.add_argument('--cylinders', type=int, default=16)
+    parser.add_argument('--points-per-unit-length', type=float, default=200.0, help="density of the points of the curves")
+    parser.add_argument('--noise', type=float, default=1e-5, help="standard deviation of the noise of the points, also used as err of the primitives")
+    parser.add_argument('--depth', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    arguments = parser.parse_args()
+    edges, primitives = make_drilled_box(arguments.cylinders, arguments.points_per_unit_length, arguments.noise, arguments.depth, arguments.seed)
+    write_scene(arguments.directory, edges, primitives)
@@ -1,57 +1,342 @@
 # Alejandro Guayaquil 02.2025
 
 from OCC.Core.gp import gp_Ax2, gp_Pnt, gp_Dir, gp_Vec
-from OCC.Core.STEPControl import STEPControl_Writer, STEPControl_AsIs
-from OCC.Core.BRepAlgoAPI import BRepAlgoAPI_Common, BRepAlgoAPI_Fuse
-from OCC.Core.BRepBuilderAPI import BRepBuilderAPI_MakeEdge, BRepBuilderAPI_MakeFace, BRepBuilderAPI_MakeWire
-from OCC.Core.BRepOffsetAPI import BRepOffsetAPI_ThruSections
-from OCC.Core.BRepPrimAPI import BRepPrimAPI_MakeCylinder
-from OCC.Core.BRepMesh import BRepMesh_IncrementalMesh
-from OCC.Core.StlAPI import StlAPI_Writer
-from OCC.Core.TopoDS import TopoDS_Compound
+from OCC.Core.BRepBuilderAPI import BRepBuilderAPI_MakeEdge, BRepBuilderAPI_MakeFace, BRepBuilderAPI_MakeWire, BRepBuilderAPI_MakePolygon
+from OCC.Core.TopoDS import TopoDS_Compound, TopoDS_Shape, TopoDS_Iterator, topods
 from OCC.Core.TopExp import TopExp_Explorer
-from OCC.Core.TopAbs import TopAbs_EDGE
-from OCC.Core.BRep import BRep_Builder
-from OCC.Core.GC import GC_MakeCircle
+from OCC.Core.TopAbs import TopAbs_EDGE, TopAbs_FACE, TopAbs_COMPOUND
+from OCC.Core.TopLoc import TopLoc_Location
+from OCC.Core.BRep import BRep_Builder, BRep_Tool
+from OCC.Core.BRepTools import breptools
+from OCC.Core.Bnd import Bnd_Box
+from OCC.Core.BRepBndLib import brepbndlib
+# The modules of the booleans, primitives, meshing and writers are imported by the functions using them, so a process only loads the stages it runs
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from collections import OrderedDict
+import contextlib
+import multiprocessing
+import subprocess
+import signal
 import platform
+import threading
+import tempfile
+import shutil
+import io
+import argparse
+import hashlib
+import re
+import struct
 import json
+import time
 import sys
 import os
 
 ARITHMETIC_TOLERANCE = 0.001
 LOG_TO_CONSOLE = False
+# A point is on a primitive (or a curve is straight) when it is within ARITHMETIC_TOLERANCE plus this multiple of the err of the
+# primitives, err being the standard deviation of their fit
+PRIMITIVE_ERR_FACTOR = 4.0
+# Upper bound of entries (points x primitives) of a residual block evaluated at once
+RESIDUAL_BLOCK_SIZE = 1 << 22
+# Sizing of the uniform grid used as spatial index of the primitives
+GRID_CELLS_PER_PRIMITIVE = 64
+GRID_MAXIMUM_CELLS = 1 << 21
+# Below this number of primitives testing every curve against every primitive is cheaper than building the grid
+GRID_MINIMUM_PRIMITIVES = 64
+# Binary input format (see write_binary_data)
+BINARY_DATA_MAGIC = b'TRIMBIN1'
+BINARY_DATA_ALIGNMENT = 64
+# Fusion of lists of shapes (see fuse_shapes_OCCT)
+FUSE_STRATEGIES = ('linear', 'tree', 'multi')
+FUSE_STRATEGY = 'tree'
+# Options of the booleans (see run_boolean_OCCT): fuzzy value as multiple of the err of the primitives taking part,
+# glue modes, and whether results are checked with BRepCheck_Analyzer to fall back to the strict mode (--check-booleans, the check
+# costs about as much as the boolean itself)
+BOOLEAN_FUZZY_FACTOR = 1.0
+BOOLEAN_GLUE_MODES = ('off', 'shift', 'full')
+BOOLEAN_CHECK_VALIDITY = False
+# Construction of the curves shown with the result: one edge per segment, or one polygon wire or B-spline edge per simplified curve
+CURVE_DISPLAY_MODES = ('segments', 'polygon', 'bspline')
+CURVE_DISPLAY_MODE = 'polygon'
+# Meshing of the STL export (see mesh_shape_OCCT): linear deflection, relative to the size of each component or absolute ('original',
+# the fixed deflection of the first versions), angular deflection (radians) and whether the linear deflection is relative
+STL_LEVELS_OF_DETAIL = {'draft': (0.02, 0.5, True), 'standard': (0.005, 0.3, True), 'fine': (0.001, 0.1, True), 'original': (0.001, 0.5, False)}
+STL_LEVEL_OF_DETAIL = 'standard'
+# Components of the result, named by trim_object when it hands them to on_component, each one can be meshed with its own level of detail
+STL_COMPONENTS = ('cube', 'cylinders')
+STL_FORMATS = ('ascii', 'binary')
+STL_FORMAT = 'ascii'
+# Formats written by the export pipeline (see start_export_pipeline), one process each
+EXPORT_FORMATS = ('step', 'stl')
+# Start method of the process pools: a forked worker would inherit the locks of the OCCT thread pool (parallel booleans) without its threads
+PROCESS_START_METHOD = 'spawn'
+# Points of the curves closer than this are welded into one (see weld_curves), well below the spacing of the samples
+WELD_TOLERANCE = 0.1 * ARITHMETIC_TOLERANCE
+# Low-memory mode (see trim_object_out_of_core): number of curves trimmed and fused together before being written to disk
+CHUNK_CURVES = 256
+# Entity numbers of a STEP file (see append_step_file)
+STEP_ENTITY_ID_PATTERN = re.compile(r'#(\d+)')
+# Seconds between two checks of the input files in watch mode (see watch_model)
+WATCH_INTERVAL = 1.0
+# Shapes fused in a single bucket by fuse_shapes_incremental_OCCT before it is split by the digits of their keys
+INCREMENTAL_FUSE_BUCKET_SIZE = 4
+# Batch processing (see run_batch)
+BATCH_SURFACES_FILE = "surface_info.json"
+BATCH_CURVES_FILE = "topo.json"
+BATCH_OUTPUT_FILES = ("trimmed.step", "trimmed.stl")
+BATCH_SUMMARY_FILE = "summary.jsonl"
+# Cache of trimmed shapes (see make_shape_cache), bump the version when trim changes its results
+SHAPE_CACHE_VERSION = 4
+SHAPE_CACHE_MEMORY_ENTRIES = 1024
+SHAPE_CACHE_DISK_BYTES = 1 << 30
+SHAPE_CACHE_FILE_SUFFIXES = ('.brep', '.json')
+# Bytes used by the directory, shared by every process using it and updated under the lock file (see update_shape_cache_disk_usage)
+SHAPE_CACHE_USAGE_FILE = "usage"
+SHAPE_CACHE_LOCK_FILE = ".lock"
+# Temporary files older than this were left by a process killed while writing, eviction removes them
+SHAPE_CACHE_STALE_SECONDS = 3600.0
 
 class Primitive:
+    __slots__ = ('id', 'tolerance')
+
     def __init__(self):
         self.id = -1
         self.tolerance = 0.0
 
 class Plane(Primitive):
+    __slots__ = ('normal', 'distance_to_origin')
+
     def __init__(self):
         super().__init__()
-        self.normal = [0.0, 0.0, 1.0]
+        self.normal = (0.0, 0.0, 1.0)
         self.distance_to_origin = 0.0
 
     def __str__(self):
         return f"\tPlane\n\t\tnormal = {self.normal}\n\t\tdistance to origin = {self.distance_to_origin}"
 
 class Cylinder(Primitive):
+    __slots__ = ('radius', 'base', 'direction')
+
     def __init__(self):
         super().__init__()
         self.radius = 1.0
-        self.base = [0.0, 0.0, 0.0]
-        self.direction = [0.0, 0.0, 1.0]
+        self.base = (0.0, 0.0, 0.0)
+        self.direction = (0.0, 0.0, 1.0)
 
     def __str__(self):
         return f"\tCylinder\n\t\tradius = {self.radius}\n\t\tbase = {self.base}\n\t\tdirection={self.direction}"
 
 class Curve:
+    # points is a float64 array (number of points x 3) and lines an int32 array (number of lines x 2)
+    __slots__ = ('primitives', 'start_end', 'points', 'lines', 'index', 'fits')
+
     def __init__(self):
         self.primitives = []
         self.start_end = []
         self.points = None
         self.lines = None
         self.index = -1
+        self.fits = {}
+
+class CurveFit:
+    # Analytic fit of a curve (see fit_curve), kind is 'line', 'circle' or 'arc'
+    # order are the indices of the points along the polyline, angles are measured in the frame (x_axis, normal x x_axis) around center
+    __slots__ = ('kind', 'order', 'center', 'normal', 'x_axis', 'direction', 'radius', 'start_angle', 'angular_span', 'start', 'end', 'residual')
+
+    def __init__(self):
+        self.kind = 'line'
+        self.order = None
+        self.center = None
+        self.normal = None
+        self.x_axis = None
+        self.direction = None
+        self.radius = 0.0
+        self.start_angle = 0.0
+        self.angular_span = 0.0
+        self.start = None
+        self.end = None
+        self.residual = 0.0
+
+class PlanarFace:
+    # Face trimmed on a plane from an open curve lying on two planes (see trim), center and tangent are the ones of the curve
+    __slots__ = ('face', 'normal', 'distance_to_origin', 'tolerance', 'center', 'tangent')
+
+    def __init__(self):
+        self.face = None
+        self.normal = (0.0, 0.0, 1.0)
+        self.distance_to_origin = 0.0
+        self.tolerance = 0.0
+        self.center = (0.0, 0.0, 0.0)
+        self.tangent = None
+
+class CurveResiduals:
+    def __init__(self):
+        self.curve_indices = None
+        self.primitive_ids = None
+        self.maximum = None
+        self.mean = None
+        self.rms = None
+
+class ShapeCache:
+    def __init__(self):
+        self.directory = None
+        self.memory = OrderedDict()
+        self.memory_entries = SHAPE_CACHE_MEMORY_ENTRIES
+        self.disk_bytes = SHAPE_CACHE_DISK_BYTES
+        self.disk_bytes_used = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+class PrimitiveGrid:
+    def __init__(self):
+        self.lower = None
+        self.cell_size = None
+        self.resolution = None
+        self.cell_offsets = None
+        self.cell_primitives = None
+
+class TopologyIndex:
+    def __init__(self):
+        self.vertices = []
+        self.curve_vertices = {}
+        self.vertex_curves = []
+        self.face_loops = []
+        self.face_loop_curves = set()
+
+class IncrementalState:
+    # Shapes of the last run (trimmed curves, face loops and nodes of the fusion trees) by content key, see trim_curves_incremental
+    def __init__(self):
+        self.previous = {}
+        self.current = {}
+        self.reused = {}
+        self.computed = {}
+
+class BooleanOptions:
+    def __init__(self):
+        self.fuzzy_value = 0.0
+        self.glue = 'off'
+        self.parallel = True
+
+class ExportPipeline:
+    def __init__(self):
+        self.outputs = {}
+        self.executors = {}
+        self.futures = []
+        self.level_of_detail = STL_LEVEL_OF_DETAIL
+        self.stl_format = STL_FORMAT
+
+class Instrumentation:
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = []
+        self.counters = {}
+
+# ===================================================
+# Instrumentation
+# ===================================================
+
+# None when instrumentation is off, then instrument returns a shared no-op context
+instrumentation = None
+NO_INSTRUMENTATION = contextlib.nullcontext()
+# Cleared by --strict-booleans, then run_boolean_OCCT ignores the fuzzy and glue options
+boolean_fast_mode = True
+# Set by --check-booleans, then run_boolean_OCCT also falls back to the strict mode when a result does not pass BRepCheck_Analyzer
+boolean_check_validity = BOOLEAN_CHECK_VALIDITY
+
+def enable_instrumentation():
+    global instrumentation
+    instrumentation = Instrumentation()
+    return instrumentation
+
+def instrument(name, category = "stage", **arguments):
+    if instrumentation is None:
+        return NO_INSTRUMENTATION
+    return record_instrumented_span(instrumentation, name, category, arguments)
+
+@contextlib.contextmanager
+def record_instrumented_span(recorder : Instrumentation, name, category, arguments):
+    # Spans of OCCT operations also count the objects created by that operation
+    if category == "occt":
+        recorder.counters[name] = recorder.counters.get(name, 0) + 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        recorder.events.append((name, category, start, end, threading.get_ident(), arguments))
+
+def record_instrumented_event(name, category, start, end, **arguments):
+    # Span measured by the caller, for operations whose arguments are only known once they are done
+    if instrumentation is None:
+        return
+    if category == "occt":
+        instrumentation.counters[name] = instrumentation.counters.get(name, 0) + 1
+    instrumentation.events.append((name, category, start, end, threading.get_ident(), arguments))
+
+def count_instrumented(name, amount = 1):
+    if instrumentation is not None:
+        instrumentation.counters[name] = instrumentation.counters.get(name, 0) + amount
+
+def take_instrumentation_of_worker():
+    # Events and counters recorded in a worker since the last call, with wall clock times since perf_counter is not shared between processes
+    if instrumentation is None:
+        return None
+    clock_offset = time.time() - time.perf_counter()
+    events = [(name, category, start + clock_offset, end + clock_offset, os.getpid(), arguments) for name, category, start, end, _, arguments in instrumentation.events]
+    counters = instrumentation.counters
+    instrumentation.events = []
+    instrumentation.counters = {}
+    return events, counters
+
+def merge_instrumentation_of_worker(worker_instrumentation):
+    # The events of a worker are shown on their own row (the process id of the worker) of the trace
+    if instrumentation is None or worker_instrumentation is None:
+        return
+    events, counters = worker_instrumentation
+    clock_offset = time.time() - time.perf_counter()
+    for name, category, start, end, worker_id, arguments in events:
+        instrumentation.events.append((name, category, start - clock_offset, end - clock_offset, worker_id, arguments))
+    for name, count in counters.items():
+        instrumentation.counters[name] = instrumentation.counters.get(name, 0) + count
+
+def measure_peak_rss():
+    # In bytes, None where the resource module is not available (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if platform.system() == "Darwin" else peak_rss * 1024
+
+def export_instrumentation_to_chrome_trace(recorder : Instrumentation, file_name):
+    # Trace event format, it can be opened with chrome://tracing or https://ui.perfetto.dev
+    process_id = os.getpid()
+    trace_events = []
+    for name, category, start, end, thread_id, arguments in recorder.events:
+        trace_events.append({'name': name, 'cat': category, 'ph': 'X', 'ts': (start - recorder.origin) * 1e6, 'dur': (end - start) * 1e6, 'pid': process_id, 'tid': thread_id, 'args': arguments})
+    end_of_trace = (time.perf_counter() - recorder.origin) * 1e6
+    trace_events.append({'name': 'counters', 'ph': 'C', 'ts': end_of_trace, 'pid': process_id, 'args': dict(recorder.counters)})
+    peak_rss = measure_peak_rss()
+    if peak_rss is not None:
+        trace_events.append({'name': 'peak_rss_MB', 'ph': 'C', 'ts': end_of_trace, 'pid': process_id, 'args': {'peak_rss': peak_rss / (1 << 20)}})
+    with open(file_name, 'w') as file:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, file)
+
+def print_instrumentation_summary(recorder : Instrumentation):
+    totals = {}
+    for name, category, start, end, _, _ in recorder.events:
+        count, total, maximum = totals.get((category, name), (0, 0.0, 0.0))
+        totals[(category, name)] = (count + 1, total + end - start, max(maximum, end - start))
+    print(f"{'category':10s} {'name':50s} {'count':>8s} {'total [s]':>12s} {'mean [s]':>12s} {'max [s]':>12s}")
+    for (category, name), (count, total, maximum) in sorted(totals.items(), key=lambda item: -item[1][1]):
+        print(f"{category:10s} {name:50s} {count:8d} {total:12.4f} {total / count:12.6f} {maximum:12.6f}")
+    for name, count in sorted(recorder.counters.items()):
+        print(f"{'counter':10s} {name:50s} {count:8d}")
+    peak_rss = measure_peak_rss()
+    if peak_rss is not None:
+        print(f"{'memory':10s} {'peak RSS [MB]':50s} {peak_rss / (1 << 20):8.1f}")
 
 # ===================================================
 # Utilities between OCCT and Python objects
@@ -144,19 +429,12 @@ def find_start_end_of_curve(curve : Curve):
             start_end_points.append(index_count)
     curve.start_end = start_end_points
 
-def make_circle_from_curve(curve : Curve):
-    point_in_circle = convert_list_to_vec3_OCCT(curve.points[0])
-    distance_point_on_opposite_side = sys.float_info.min
-    point_on_opposite_side = gp_Pnt(0.0, 0.0, 0.0)
-    for point in curve.points:
-        P = convert_list_to_vec3_OCCT(point)
-        distance = (P - point_in_circle).Magnitude()
-        if (distance > distance_point_on_opposite_side):
-            point_on_opposite_side = P
-            distance_point_on_opposite_side = distance
-    center_of_mass = multiply_vec3_OCCT_with_scalar((point_in_circle + point_on_opposite_side), 0.5)
-    radius = distance_point_on_opposite_side * 0.5
-    return radius, center_of_mass
+def make_circle_from_curve(curve : Curve, err = 0.0):
+    # Circle fitted to the points (see fit_curve), a straight curve gives the circle having it as diameter
+    fit = fit_curve(curve, err=err)
+    if fit.kind == 'line':
+        return 0.5 * np.linalg.norm(fit.end - fit.start), convert_list_to_vec3_OCCT(fit.center)
+    return fit.radius, convert_list_to_vec3_OCCT(fit.center)
 
 def collect_primitives_as_objects(primitives : list):
     if len(primitives) == 0:
@@ -167,13 +445,13 @@ def collect_primitives_as_objects(primitives : list):
         primitive_as_object = Primitive()
         if (primitive['type'] == "plane"):
             plane = Plane()
-            plane.normal = params[0][0]
+            plane.normal = tuple(params[0][0])
             plane.distance_to_origin = params[1]
             primitive_as_object = plane            
         elif (primitive['type'] == "cylinder"):
             cylinder = Cylinder()
-            cylinder.direction = params[0]
-            cylinder.base = params[1]
+            cylinder.direction = tuple(params[0])
+            cylinder.base = tuple(params[1])
             cylinder.radius = params[2]
             primitive_as_object = cylinder
         else:
@@ -183,7 +461,11 @@ def collect_primitives_as_objects(primitives : list):
         result.append(primitive_as_object)
     return result
 
-def find_primitives_for_curve(curve : Curve, primitives : list):
+def find_primitives_for_curve(curve : Curve, primitives : list, grid = None):
+    if grid is not None:
+        curve_points = np.asarray(curve.points, dtype=np.float64)
+        candidates = find_candidate_primitives_in_grid(grid, curve_points.min(axis=0) - ARITHMETIC_TOLERANCE, curve_points.max(axis=0) + ARITHMETIC_TOLERANCE)
+        primitives = [primitives[primitive_index] for primitive_index in candidates]
     for primitive in primitives:
         primitive_found = False
         if isinstance(primitive, Plane):
@@ -195,11 +477,604 @@ def find_primitives_for_curve(curve : Curve, primitives : list):
         if primitive_found:
             curve.primitives.append(primitive.id)
 
+def collect_curves_as_objects(edges):
+    curves = []
+    for curve_index, curve in enumerate(edges['curves']):
+        curve_as_object = Curve()
+        curve_as_object.points = np.asarray(curve['pv_points'], dtype=np.float64).reshape(-1, 3)
+        curve_as_object.lines = np.asarray(curve['pv_lines'], dtype=np.int32).reshape(-1, 2)
+        # Index of the curve in topo.json, kept by weld_curves when it drops curves
+        curve_as_object.index = curve.get('index', curve_index)
+        curves.append(curve_as_object)
+    return curves
+
+# ===================================================
+# Batch geometric operations based on NumPy
+# ===================================================
+
+def collect_curves_points_as_array(curves : list):
+    number_of_points = np.array([len(curve.points) for curve in curves], dtype=np.int64)
+    offsets = np.zeros(len(curves) + 1, dtype=np.int64)
+    np.cumsum(number_of_points, out=offsets[1:])
+    points = np.empty((offsets[-1], 3), dtype=np.float64)
+    for curve_index, curve in enumerate(curves):
+        points[offsets[curve_index]:offsets[curve_index + 1]] = curve.points
+    return points, offsets
+
+def collect_primitives_as_arrays(primitives : list):
+    number_of_primitives = len(primitives)
+    is_plane = np.zeros(number_of_primitives, dtype=bool)
+    is_cylinder = np.zeros(number_of_primitives, dtype=bool)
+    directions = np.zeros((number_of_primitives, 3), dtype=np.float64)
+    bases = np.zeros((number_of_primitives, 3), dtype=np.float64)
+    scalars = np.zeros(number_of_primitives, dtype=np.float64)
+    tolerances = np.zeros(number_of_primitives, dtype=np.float64)
+    for primitive_index, primitive in enumerate(primitives):
+        if isinstance(primitive, Plane):
+            is_plane[primitive_index] = True
+            directions[primitive_index] = primitive.normal
+            scalars[primitive_index] = primitive.distance_to_origin
+        elif isinstance(primitive, Cylinder):
+            is_cylinder[primitive_index] = True
+            directions[primitive_index] = primitive.direction
+            bases[primitive_index] = primitive.base
+            scalars[primitive_index] = primitive.radius
+        tolerances[primitive_index] = primitive.tolerance
+    lengths = np.linalg.norm(directions, axis=1)
+    lengths[lengths == 0.0] = 1.0
+    directions /= lengths[:, None]
+    return is_plane, is_cylinder, directions, bases, scalars, tolerances
+
+def compute_residuals_points_to_primitives(points, is_plane, is_cylinder, directions, bases, scalars):
+    # Plane     : |P.N - D|
+    # Cylinder  : | ||(P - P0) x d|| - r | with ||(P - P0) x d||^2 = ||P - P0||^2 - ((P - P0).d)^2
+    residuals = np.full((len(points), len(is_plane)), np.inf)
+    projections = points @ directions.T
+    residuals[:, is_plane] = np.abs(projections[:, is_plane] - scalars[is_plane])
+    if np.any(is_cylinder):
+        cylinder_bases = bases[is_cylinder]
+        axial = projections[:, is_cylinder] - np.einsum('ij,ij->i', cylinder_bases, directions[is_cylinder])
+        squared_distance = np.einsum('ij,ij->i', points, points)[:, None] - 2.0 * (points @ cylinder_bases.T) + np.einsum('ij,ij->i', cylinder_bases, cylinder_bases)
+        radial = np.sqrt(np.maximum(squared_distance - axial * axial, 0.0))
+        residuals[:, is_cylinder] = np.abs(radial - scalars[is_cylinder])
+    return residuals
+
+def compute_residuals_points_to_primitives_pairwise(points, primitive_indices, is_plane, directions, bases, scalars):
+    # Same as compute_residuals_points_to_primitives but row i is evaluated only against primitive_indices[i]
+    relative = points - bases[primitive_indices]
+    axial = np.einsum('ij,ij->i', relative, directions[primitive_indices])
+    radial = np.sqrt(np.maximum(np.einsum('ij,ij->i', relative, relative) - axial * axial, 0.0))
+    return np.abs(np.where(is_plane[primitive_indices], axial, radial) - scalars[primitive_indices])
+
+def find_primitives_for_curves_dense(points, offsets, primitive_arrays):
+    is_plane, is_cylinder, directions, bases, scalars, _ = primitive_arrays
+    number_of_curves = len(offsets) - 1
+    number_of_primitives = len(is_plane)
+    maximum = np.zeros((number_of_curves, number_of_primitives))
+    total = np.zeros((number_of_curves, number_of_primitives))
+    total_squared = np.zeros((number_of_curves, number_of_primitives))
+    points_per_block = max(1, RESIDUAL_BLOCK_SIZE // max(1, number_of_primitives))
+    first_curve = 0
+    while first_curve < number_of_curves:
+        last_curve = first_curve + 1
+        while last_curve < number_of_curves and offsets[last_curve + 1] - offsets[first_curve] <= points_per_block:
+            last_curve += 1
+        block_offsets = offsets[first_curve:last_curve + 1]
+        residuals = compute_residuals_points_to_primitives(points[block_offsets[0]:block_offsets[-1]], is_plane, is_cylinder, directions, bases, scalars)
+        starts = block_offsets[:-1] - block_offsets[0]
+        maximum[first_curve:last_curve] = np.maximum.reduceat(residuals, starts, axis=0)
+        total[first_curve:last_curve] = np.add.reduceat(residuals, starts, axis=0)
+        total_squared[first_curve:last_curve] = np.add.reduceat(residuals * residuals, starts, axis=0)
+        first_curve = last_curve
+    pair_curves, pair_primitives = np.indices((number_of_curves, number_of_primitives)).reshape(2, -1)
+    return pair_curves, pair_primitives, maximum.ravel(), total.ravel(), total_squared.ravel()
+
+def find_primitives_for_curves_sparse(points, offsets, primitive_arrays, pair_curves, pair_primitives):
+    is_plane, _, directions, bases, scalars, _ = primitive_arrays
+    number_of_pairs = len(pair_curves)
+    maximum = np.zeros(number_of_pairs)
+    total = np.zeros(number_of_pairs)
+    total_squared = np.zeros(number_of_pairs)
+    pair_counts = offsets[pair_curves + 1] - offsets[pair_curves]
+    pair_ends = np.cumsum(pair_counts)
+    first_pair = 0
+    while first_pair < number_of_pairs:
+        last_pair = int(np.searchsorted(pair_ends, pair_ends[first_pair] - pair_counts[first_pair] + RESIDUAL_BLOCK_SIZE, side='right'))
+        last_pair = max(last_pair, first_pair + 1)
+        counts = pair_counts[first_pair:last_pair]
+        starts = np.cumsum(counts) - counts
+        rows = np.arange(starts[-1] + counts[-1]) - np.repeat(starts, counts)
+        point_indices = rows + np.repeat(offsets[pair_curves[first_pair:last_pair]], counts)
+        primitive_indices = np.repeat(pair_primitives[first_pair:last_pair], counts)
+        residuals = compute_residuals_points_to_primitives_pairwise(points[point_indices], primitive_indices, is_plane, directions, bases, scalars)
+        maximum[first_pair:last_pair] = np.maximum.reduceat(residuals, starts)
+        total[first_pair:last_pair] = np.add.reduceat(residuals, starts)
+        total_squared[first_pair:last_pair] = np.add.reduceat(residuals * residuals, starts)
+        first_pair = last_pair
+    return maximum, total, total_squared
+
+def find_primitives_for_curves(curves : list, primitives : list, tolerance = ARITHMETIC_TOLERANCE, grid = None):
+    points, offsets = collect_curves_points_as_array(curves)
+    primitive_arrays = collect_primitives_as_arrays(primitives)
+    tolerances = primitive_arrays[5]
+    if grid is None:
+        pair_curves, pair_primitives, maximum, total, total_squared = find_primitives_for_curves_dense(points, offsets, primitive_arrays)
+    else:
+        pair_curves, pair_primitives = find_candidate_pairs_in_primitive_grid(grid, points, offsets, tolerance)
+        maximum, total, total_squared = find_primitives_for_curves_sparse(points, offsets, primitive_arrays, pair_curves, pair_primitives)
+    counts = np.maximum(offsets[pair_curves + 1] - offsets[pair_curves], 1)
+    statistics = CurveResiduals()
+    primitive_ids = np.array([primitive.id for primitive in primitives], dtype=np.int64)
+    statistics.curve_indices = pair_curves
+    statistics.primitive_ids = primitive_ids[pair_primitives]
+    statistics.maximum = maximum
+    statistics.mean = total / counts
+    statistics.rms = np.sqrt(total_squared / counts)
+    is_on_primitive = maximum <= (tolerance + PRIMITIVE_ERR_FACTOR * tolerances[pair_primitives])
+    for curve in curves:
+        curve.primitives = []
+    # Pairs are sorted by curve and then by primitive so the order of curve.primitives follows the input primitives
+    for curve_index, primitive_index in zip(pair_curves[is_on_primitive], pair_primitives[is_on_primitive]):
+        curves[curve_index].primitives.append(int(primitive_ids[primitive_index]))
+    return statistics
+
+# ===================================================
+# Preprocessing of the curves
+# ===================================================
+
+def expand_pairs_of_blocks(first_starts, first_counts, second_starts, second_counts):
+    # Every pair (i, j) with i in [first_start, first_start + first_count) and j in [second_start, second_start + second_count), block by block
+    sizes = first_counts * second_counts
+    blocks = np.repeat(np.arange(len(sizes)), sizes)
+    positions = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    return first_starts[blocks] + positions // second_counts[blocks], second_starts[blocks] + positions % second_counts[blocks]
+
+def find_close_pairs_of_points(points, tolerance = WELD_TOLERANCE):
+    # Hashed grid of cell size tolerance: pairs are searched in the same cell and in the 13 neighbour cells of the upper half
+    cells = np.floor((points - points.min(axis=0)) / tolerance).astype(np.int64)
+    resolution = cells.max(axis=0) + 3
+    keys = ((cells[:, 0] + 1) * resolution[1] + (cells[:, 1] + 1)) * resolution[2] + (cells[:, 2] + 1)
+    order = np.argsort(keys, kind='stable')
+    unique_keys, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+    pairs_first = []
+    pairs_second = []
+    offsets = [(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1) if (i, j, k) > (0, 0, 0)]
+    for i, j, k in [(0, 0, 0)] + offsets:
+        neighbour_keys = unique_keys + (i * resolution[1] + j) * resolution[2] + k
+        neighbours = np.minimum(np.searchsorted(unique_keys, neighbour_keys), len(unique_keys) - 1)
+        is_found = unique_keys[neighbours] == neighbour_keys
+        first, second = expand_pairs_of_blocks(starts[is_found], counts[is_found], starts[neighbours[is_found]], counts[neighbours[is_found]])
+        if (i, j, k) == (0, 0, 0):
+            is_kept = first < second
+            first, second = first[is_kept], second[is_kept]
+        pairs_first.append(order[first])
+        pairs_second.append(order[second])
+    first = np.concatenate(pairs_first)
+    second = np.concatenate(pairs_second)
+    difference = points[first] - points[second]
+    is_close = np.einsum('ij,ij->i', difference, difference) <= tolerance * tolerance
+    return first[is_close], second[is_close]
+
+def label_points_by_representatives(number_of_points, first, second):
+    # Greedy clustering: in the order of the points, a point not yet labelled becomes a representative and labels the unlabelled points
+    # paired with it, so every point is within tolerance of its representative (connected components would chain along dense curves)
+    labels = np.arange(number_of_points)
+    if len(first) == 0:
+        return labels
+    sources = np.concatenate([first, second])
+    targets = np.concatenate([second, first])
+    order = np.argsort(sources, kind='stable')
+    sources, targets = sources[order], targets[order]
+    starts = np.searchsorted(sources, np.arange(number_of_points + 1))
+    is_labelled = np.zeros(number_of_points, dtype=bool)
+    for point in np.unique(sources):
+        if is_labelled[point]:
+            continue
+        neighbours = targets[starts[point]:starts[point + 1]]
+        neighbours = neighbours[~is_labelled[neighbours]]
+        labels[neighbours] = point
+        is_labelled[neighbours] = True
+        is_labelled[point] = True
+    return labels
+
+def weld_curves(edges, tolerance = WELD_TOLERANCE):
+    # Points within tolerance of a representative point (see label_points_by_representatives), in the same curve or in curves meeting at a
+    # corner, are replaced by it, so no point moves by more than tolerance, the lines are remapped and
+    # the zero-length or repeated lines dropped. Curves whose welded points all belong to another curve (duplicates, overlaps) are dropped
+    # Returns edges with the welded curves (arrays instead of lists, 'index' being the index of the curve in the input) and the other entries unchanged
+    curves = edges['curves']
+    if len(curves) == 0:
+        return edges
+    if tolerance > ARITHMETIC_TOLERANCE:
+        print("Warning: weld tolerance", tolerance, "above ARITHMETIC_TOLERANCE, welded points can leave their primitives")
+    points_per_curve = [np.asarray(curve['pv_points'], dtype=np.float64).reshape(-1, 3) for curve in curves]
+    lines_per_curve = [np.asarray(curve['pv_lines'], dtype=np.int64).reshape(-1, 2) for curve in curves]
+    points_counts = np.array([len(points) for points in points_per_curve])
+    lines_counts = np.array([len(lines) for lines in lines_per_curve])
+    points = np.concatenate(points_per_curve)
+    point_offsets = np.concatenate([[0], np.cumsum(points_counts)])
+    point_curves = np.repeat(np.arange(len(curves)), points_counts)
+    # Welding
+    labels = label_points_by_representatives(len(points), *find_close_pairs_of_points(points, tolerance))
+    welded_points = points[labels]
+    # New points of every curve: one per label, in the order of their first occurrence in the curve
+    _, first_occurrences, inverse = np.unique(point_curves * len(points) + labels, return_index=True, return_inverse=True)
+    ranks = np.empty(len(first_occurrences), dtype=np.int64)
+    ranks[np.argsort(first_occurrences, kind='stable')] = np.arange(len(first_occurrences))
+    new_indices = ranks[inverse.reshape(-1)]
+    kept_points = np.sort(first_occurrences)
+    new_point_counts = np.bincount(point_curves[kept_points], minlength=len(curves))
+    new_point_offsets = np.concatenate([[0], np.cumsum(new_point_counts)])
+    # Lines remapped to the new points, without zero-length and repeated lines
+    lines = np.concatenate(lines_per_curve) + np.repeat(point_offsets[:-1], lines_counts)[:, None]
+    line_curves = np.repeat(np.arange(len(curves)), lines_counts)
+    lines = np.sort(new_indices[lines], axis=1)
+    is_kept = lines[:, 0] != lines[:, 1]
+    lines, line_curves = lines[is_kept], line_curves[is_kept]
+    _, unique_lines = np.unique(lines[:, 0] * len(points) + lines[:, 1], return_index=True)
+    unique_lines = np.sort(unique_lines)
+    lines, line_curves = lines[unique_lines], line_curves[unique_lines]
+    line_offsets = np.searchsorted(line_curves, np.arange(len(curves) + 1))
+    # Curves contained in another curve: count, for every pair of curves sharing a label, the labels they share
+    curve_labels = np.unique(labels * len(curves) + point_curves)
+    curve_labels = np.stack([curve_labels // len(curves), curve_labels % len(curves)], axis=1)
+    labels_per_curve = np.bincount(curve_labels[:, 1], minlength=len(curves))
+    shared_counts = {}
+    label_starts = np.flatnonzero(np.diff(curve_labels[:, 0], prepend=-1))
+    label_ends = np.append(label_starts[1:], len(curve_labels))
+    for start, end in zip(label_starts, label_ends):
+        if end - start < 2:
+            continue
+        label_curves = curve_labels[start:end, 1]
+        for first_curve in label_curves:
+            for second_curve in label_curves:
+                if first_curve != second_curve:
+                    shared_counts[(first_curve, second_curve)] = shared_counts.get((first_curve, second_curve), 0) + 1
+    is_dropped = np.zeros(len(curves), dtype=bool)
+    for (curve_index, other_curve_index), shared_count in sorted(shared_counts.items()):
+        if shared_count < labels_per_curve[curve_index] or is_dropped[other_curve_index]:
+            continue
+        # Of two identical curves the first one is kept
+        if labels_per_curve[other_curve_index] == shared_count and other_curve_index > curve_index:
+            continue
+        is_dropped[curve_index] = True
+    welded_curves = []
+    for curve_index in range(len(curves)):
+        if is_dropped[curve_index]:
+            continue
+        curve_lines = lines[line_offsets[curve_index]:line_offsets[curve_index + 1]] - new_point_offsets[curve_index]
+        if len(curve_lines) == 0:
+            is_dropped[curve_index] = True
+            continue
+        welded_curves.append({'pv_points': welded_points[kept_points[new_point_offsets[curve_index]:new_point_offsets[curve_index + 1]]], 'pv_lines': curve_lines.astype(np.int32), 'index': curves[curve_index].get('index', curve_index)})
+    number_of_welded_points = sum(len(curve['pv_points']) for curve in welded_curves)
+    number_of_welded_lines = sum(len(curve['pv_lines']) for curve in welded_curves)
+    print(f"Welding: {len(points)} -> {number_of_welded_points} points, {lines_counts.sum()} -> {number_of_welded_lines} lines, "
+          f"{len(curves)} -> {len(welded_curves)} curves (reduction ratio {len(points) / max(number_of_welded_points, 1):.2f})")
+    welded_edges = dict(edges)
+    welded_edges['curves'] = welded_curves
+    return welded_edges
+
+# ===================================================
+# Spatial index of primitives (uniform grid)
+# ===================================================
+
+def build_primitive_grid(primitives : list, points, tolerance = ARITHMETIC_TOLERANCE):
+    grid = PrimitiveGrid()
+    is_plane, is_cylinder, directions, bases, scalars, tolerances = collect_primitives_as_arrays(primitives)
+    padding = tolerance + PRIMITIVE_ERR_FACTOR * (tolerances.max() if len(tolerances) else 0.0)
+    lower = points.min(axis=0) - padding
+    upper = points.max(axis=0) + padding
+    extents = upper - lower
+    number_of_cells = min(GRID_MAXIMUM_CELLS, max(1, GRID_CELLS_PER_PRIMITIVE * len(primitives)))
+    cell_size = (np.prod(extents) / number_of_cells) ** (1.0 / 3.0)
+    grid.resolution = np.clip(np.ceil(extents / cell_size), 1, None).astype(np.int64)
+    grid.lower = lower
+    grid.cell_size = extents / grid.resolution
+    cells_of_primitives = []
+    for primitive_index in range(len(primitives)):
+        margin = tolerance + PRIMITIVE_ERR_FACTOR * tolerances[primitive_index]
+        if is_plane[primitive_index]:
+            cells = find_cells_of_plane_in_grid(grid, directions[primitive_index], scalars[primitive_index], margin)
+        elif is_cylinder[primitive_index]:
+            cells = find_cells_of_cylinder_in_grid(grid, directions[primitive_index], bases[primitive_index], scalars[primitive_index], margin)
+        else:
+            cells = np.zeros(0, dtype=np.int64)
+        cells_of_primitives.append(cells)
+    counts = np.array([len(cells) for cells in cells_of_primitives], dtype=np.int64)
+    cells = np.concatenate(cells_of_primitives) if len(cells_of_primitives) else np.zeros(0, dtype=np.int64)
+    owners = np.repeat(np.arange(len(primitives), dtype=np.int64), counts)
+    order = np.argsort(cells, kind='stable')
+    grid.cell_primitives = owners[order]
+    grid.cell_offsets = np.searchsorted(cells[order], np.arange(np.prod(grid.resolution) + 1))
+    return grid
+
+def flatten_cell_indices_of_grid(grid, i, j, k):
+    return (i * grid.resolution[1] + j) * grid.resolution[2] + k
+
+def expand_ranges_of_cells(first, last):
+    # Expands the inclusive ranges [first, last] into the list of integers they contain
+    counts = np.maximum(last - first + 1, 0)
+    starts = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) - np.repeat(starts, counts) + np.repeat(first, counts), counts
+
+def find_cells_of_plane_in_grid(grid, normal, distance, margin):
+    # Sweep the columns along the axis where the normal is dominant and solve the slab for that axis
+    k = int(np.argmax(np.abs(normal)))
+    a, b = [axis for axis in range(3) if axis != k]
+    ia, ib = np.meshgrid(np.arange(grid.resolution[a]), np.arange(grid.resolution[b]), indexing='ij')
+    ia, ib = ia.ravel(), ib.ravel()
+    xa = grid.lower[a] + grid.cell_size[a] * np.stack([ia, ia + 1])
+    xb = grid.lower[b] + grid.cell_size[b] * np.stack([ib, ib + 1])
+    terms_a = normal[a] * xa
+    terms_b = normal[b] * xb
+    bound1 = (distance - margin - terms_a.max(axis=0) - terms_b.max(axis=0)) / normal[k]
+    bound2 = (distance + margin - terms_a.min(axis=0) - terms_b.min(axis=0)) / normal[k]
+    lowest = np.floor((np.minimum(bound1, bound2) - grid.lower[k]) / grid.cell_size[k]).astype(np.int64)
+    highest = np.floor((np.maximum(bound1, bound2) - grid.lower[k]) / grid.cell_size[k]).astype(np.int64)
+    lowest = np.maximum(lowest, 0)
+    highest = np.minimum(highest, grid.resolution[k] - 1)
+    ik, counts = expand_ranges_of_cells(lowest, highest)
+    index = [None, None, None]
+    index[a] = np.repeat(ia, counts)
+    index[b] = np.repeat(ib, counts)
+    index[k] = ik
+    return flatten_cell_indices_of_grid(grid, *index)
+
+def find_cells_of_cylinder_in_grid(grid, direction, base, radius, margin):
+    # Sweep the slabs along the axis where the direction is dominant, each slab holds a bounding box of the cylinder piece
+    k = int(np.argmax(np.abs(direction)))
+    a, b = [axis for axis in range(3) if axis != k]
+    half_width = (radius + margin) * np.sqrt(np.maximum(1.0 - direction * direction, 0.0))
+    ik = np.arange(grid.resolution[k])
+    xk = grid.lower[k] + grid.cell_size[k] * np.stack([ik, ik + 1])
+    t = (xk - base[k]) / direction[k]
+    first = []
+    last = []
+    for axis in (a, b):
+        on_axis = base[axis] + t * direction[axis]
+        lowest = np.floor((on_axis.min(axis=0) - half_width[axis] - grid.lower[axis]) / grid.cell_size[axis]).astype(np.int64)
+        highest = np.floor((on_axis.max(axis=0) + half_width[axis] - grid.lower[axis]) / grid.cell_size[axis]).astype(np.int64)
+        first.append(np.maximum(lowest, 0))
+        last.append(np.minimum(highest, grid.resolution[axis] - 1))
+    cells = []
+    for slab in range(len(ik)):
+        if first[0][slab] > last[0][slab] or first[1][slab] > last[1][slab]:
+            continue
+        ia, ib = np.meshgrid(np.arange(first[0][slab], last[0][slab] + 1), np.arange(first[1][slab], last[1][slab] + 1), indexing='ij')
+        index = [None, None, None]
+        index[a] = ia.ravel()
+        index[b] = ib.ravel()
+        index[k] = np.full(ia.size, slab)
+        cells.append(flatten_cell_indices_of_grid(grid, *index))
+    return np.concatenate(cells) if len(cells) else np.zeros(0, dtype=np.int64)
+
+def find_candidate_primitives_in_grid(grid, lower, upper):
+    first = np.clip(np.floor((lower - grid.lower) / grid.cell_size).astype(np.int64), 0, grid.resolution - 1)
+    last = np.clip(np.floor((upper - grid.lower) / grid.cell_size).astype(np.int64), 0, grid.resolution - 1)
+    i, j, k = np.meshgrid(*[np.arange(first[axis], last[axis] + 1) for axis in range(3)], indexing='ij')
+    cells = flatten_cell_indices_of_grid(grid, i.ravel(), j.ravel(), k.ravel())
+    candidates, _ = expand_ranges_of_cells(grid.cell_offsets[cells], grid.cell_offsets[cells + 1] - 1)
+    return np.unique(grid.cell_primitives[candidates])
+
+def find_candidate_pairs_in_primitive_grid(grid, points, offsets, tolerance = ARITHMETIC_TOLERANCE):
+    pair_curves = []
+    pair_primitives = []
+    for curve_index in range(len(offsets) - 1):
+        curve_points = points[offsets[curve_index]:offsets[curve_index + 1]]
+        if len(curve_points) == 0:
+            continue
+        candidates = find_candidate_primitives_in_grid(grid, curve_points.min(axis=0) - tolerance, curve_points.max(axis=0) + tolerance)
+        pair_curves.append(np.full(len(candidates), curve_index, dtype=np.int64))
+        pair_primitives.append(candidates)
+    if len(pair_curves) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(pair_curves), np.concatenate(pair_primitives)
+
+# ===================================================
+# Topology index
+# ===================================================
+
+def snap_point_to_vertex(topology : TopologyIndex, vertex_cells, point, tolerance = ARITHMETIC_TOLERANCE):
+    # Vertices are hashed in cells of size tolerance, so only the 27 cells around the point are checked
+    cell = tuple(int(np.floor(coordinate / tolerance)) for coordinate in point)
+    for offset in np.ndindex(3, 3, 3):
+        neighbour = (cell[0] + offset[0] - 1, cell[1] + offset[1] - 1, cell[2] + offset[2] - 1)
+        for vertex_index in vertex_cells.get(neighbour, ()):
+            if np.linalg.norm(topology.vertices[vertex_index] - point) <= tolerance:
+                return vertex_index
+    vertex_index = len(topology.vertices)
+    topology.vertices.append(np.asarray(point, dtype=np.float64))
+    topology.vertex_curves.append([])
+    vertex_cells.setdefault(cell, []).append(vertex_index)
+    return vertex_index
+
+def find_face_loops_of_plane(topology : TopologyIndex, plane_curves : list):
+    # A loop is a connected set of curves where every vertex is shared by exactly two of them
+    vertex_curves = {}
+    for curve_index in plane_curves:
+        for vertex_index in topology.curve_vertices[curve_index]:
+            vertex_curves.setdefault(vertex_index, []).append(curve_index)
+    visited = set()
+    face_loops = []
+    for first_curve in plane_curves:
+        if first_curve in visited:
+            continue
+        face_loop = []
+        is_loop = True
+        curve_index = first_curve
+        vertex_index = topology.curve_vertices[first_curve][0]
+        while curve_index is not None and curve_index not in visited:
+            visited.add(curve_index)
+            face_loop.append(curve_index)
+            start, end = topology.curve_vertices[curve_index]
+            vertex_index = end if vertex_index == start else start
+            neighbours = vertex_curves[vertex_index]
+            if len(neighbours) != 2:
+                is_loop = False
+                break
+            curve_index = neighbours[0] if neighbours[1] == curve_index else neighbours[1]
+        if is_loop and curve_index == first_curve and len(face_loop) > 2:
+            face_loops.append(face_loop)
+    return face_loops
+
+def build_topology_index(curves : list, primitives : list, corners = [], tolerance = ARITHMETIC_TOLERANCE):
+    # Endpoints of open curves are snapped to the corners (or to each other), curves lying on two planes
+    # are grouped by plane and the cycles of each group are the planar face loops
+    # Curves are referred to by their position in curves, which is not curve.index once weld_curves dropped some
+    topology = TopologyIndex()
+    vertex_cells = {}
+    # The endpoints carry the noise of the points, bounded as in the classification (see PRIMITIVE_ERR_FACTOR)
+    tolerance = tolerance + PRIMITIVE_ERR_FACTOR * max((primitive.tolerance for primitive in primitives), default=0.0)
+    for corner in corners:
+        snap_point_to_vertex(topology, vertex_cells, np.asarray(corner, dtype=np.float64), tolerance)
+    curves_of_plane = {}
+    for curve_index, curve in enumerate(curves):
+        find_start_end_of_curve(curve)
+        if len(curve.start_end) != 2:
+            continue
+        curve_vertices = tuple(snap_point_to_vertex(topology, vertex_cells, curve.points[point_index], tolerance) for point_index in curve.start_end)
+        topology.curve_vertices[curve_index] = curve_vertices
+        for vertex_index in curve_vertices:
+            topology.vertex_curves[vertex_index].append(curve_index)
+        if len(curve.primitives) > 0 and all(isinstance(primitives[primitive_index], Plane) for primitive_index in curve.primitives):
+            for primitive_index in curve.primitives:
+                curves_of_plane.setdefault(primitive_index, []).append(curve_index)
+    for plane_index, plane_curves in curves_of_plane.items():
+        for face_loop in find_face_loops_of_plane(topology, plane_curves):
+            topology.face_loops.append((plane_index, face_loop))
+            topology.face_loop_curves.update(face_loop)
+    return topology
+
+# ===================================================
+# Analytic curve fitting
+# ===================================================
+
+def order_curve_points(curve : Curve):
+    # Walk of the lines graph from an endpoint (or from any point of a closed curve), every point has at most two neighbours
+    lines = np.asarray(curve.lines, dtype=np.int64).reshape(-1, 2)
+    if len(lines) == 0:
+        return np.arange(len(curve.points))
+    sources = np.concatenate([lines[:, 0], lines[:, 1]])
+    targets = np.concatenate([lines[:, 1], lines[:, 0]])
+    sorting = np.argsort(sources, kind='stable')
+    sources = sources[sorting]
+    targets = targets[sorting]
+    slots = np.arange(len(sources)) - np.searchsorted(sources, sources)
+    is_kept = slots < 2
+    neighbours = np.full((len(curve.points), 2), -1, dtype=np.int64)
+    neighbours[sources[is_kept], slots[is_kept]] = targets[is_kept]
+    neighbours = neighbours.tolist()
+    start = int(curve.start_end[0]) if len(curve.start_end) > 0 else int(lines[0, 0])
+    order = [start]
+    previous = -1
+    current = start
+    while len(order) <= len(neighbours):
+        first, second = neighbours[current]
+        following = first if first != previous else second
+        if following == -1 or following == start:
+            break
+        order.append(following)
+        previous = current
+        current = following
+    return np.array(order, dtype=np.int64)
+
+def fit_circle_in_plane(u, v):
+    # Algebraic least squares circle (u - a)^2 + (v - b)^2 = r^2, linear in a, b and c = r^2 - a^2 - b^2
+    system = np.stack([2.0 * u, 2.0 * v, np.ones_like(u)], axis=1)
+    (a, b, c), _, _, _ = np.linalg.lstsq(system, u * u + v * v, rcond=None)
+    return a, b, np.sqrt(max(c + a * a + b * b, 0.0))
+
+def fit_curve(curve : Curve, tolerance = ARITHMETIC_TOLERANCE, err = 0.0):
+    # Open curves within tolerance (plus the err of their primitives, see PRIMITIVE_ERR_FACTOR) of their principal axis are lines,
+    # the other ones are circles (closed) or arcs (open)
+    # The fit is cached on the curve for every (tolerance, err), the kind of a curve depends on them
+    key = (tolerance, err)
+    if key in curve.fits:
+        return curve.fits[key]
+    fit = CurveFit()
+    fit.order = order_curve_points(curve)
+    points = np.asarray(curve.points, dtype=np.float64)[fit.order]
+    centroid = points.mean(axis=0)
+    centered = points - centroid
+    # Principal axes by decreasing variance, the last one is the normal of the best fitting plane
+    _, eigenvectors = np.linalg.eigh(centered.T @ centered)
+    axes = eigenvectors[:, ::-1].T
+    # Right-handed, so the angles around normal are measured from x_axis towards normal x x_axis
+    axes[2] = np.cross(axes[0], axes[1])
+    is_curve_closed = (len(curve.start_end) == 0)
+    distances_to_axis = np.linalg.norm(np.cross(centered, axes[0]), axis=1)
+    if not is_curve_closed and distances_to_axis.max() <= tolerance + PRIMITIVE_ERR_FACTOR * err:
+        fit.kind = 'line'
+        fit.direction = axes[0]
+        fit.start = centroid + np.dot(centered[0], axes[0]) * axes[0]
+        fit.end = centroid + np.dot(centered[-1], axes[0]) * axes[0]
+        fit.center = 0.5 * (fit.start + fit.end)
+        fit.residual = float(np.sqrt(np.mean(distances_to_axis * distances_to_axis)))
+        curve.fits[key] = fit
+        return fit
+    u = centered @ axes[0]
+    v = centered @ axes[1]
+    w = centered @ axes[2]
+    a, b, fit.radius = fit_circle_in_plane(u, v)
+    fit.center = centroid + a * axes[0] + b * axes[1]
+    fit.normal = axes[2]
+    fit.x_axis = axes[0]
+    deviations = np.hypot(np.hypot(u - a, v - b) - fit.radius, w)
+    fit.residual = float(np.sqrt(np.mean(deviations * deviations)))
+    angles = np.unwrap(np.arctan2(v - b, u - a))
+    if is_curve_closed:
+        fit.kind = 'circle'
+        fit.start_angle = float(angles[0])
+        fit.angular_span = 2.0 * np.pi
+    else:
+        fit.kind = 'arc'
+        fit.start_angle = float(angles[0])
+        fit.angular_span = float(angles[-1] - angles[0])
+        fit.start = points[0]
+        fit.end = points[-1]
+    curve.fits[key] = fit
+    return fit
+
+def simplify_polyline(points, tolerance = ARITHMETIC_TOLERANCE):
+    # Douglas-Peucker, returns the indices of the points kept so that no point is further than tolerance from the simplified polyline
+    is_kept = np.zeros(len(points), dtype=bool)
+    is_kept[[0, -1]] = True
+    ranges = [(0, len(points) - 1)]
+    while ranges:
+        first, last = ranges.pop()
+        if last - first < 2:
+            continue
+        segment = points[last] - points[first]
+        inner = points[first + 1:last] - points[first]
+        length_squared = np.dot(segment, segment)
+        if length_squared > 0.0:
+            parameters = np.clip(inner @ segment / length_squared, 0.0, 1.0)
+            inner = inner - parameters[:, None] * segment
+        distances = np.einsum('ij,ij->i', inner, inner)
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance * tolerance:
+            farthest += first + 1
+            is_kept[farthest] = True
+            ranges.append((first, farthest))
+            ranges.append((farthest, last))
+    return np.flatnonzero(is_kept)
+
+def simplify_curve(curve : Curve, tolerance = ARITHMETIC_TOLERANCE):
+    # Points of the curve in the order of the polyline, simplified to tolerance, a closed curve is simplified as a loop
+    points = np.asarray(curve.points, dtype=np.float64)[order_curve_points(curve)]
+    is_curve_closed = (len(curve.start_end) == 0)
+    if is_curve_closed:
+        points = np.vstack([points, points[:1]])
+    points = points[simplify_polyline(points, tolerance)]
+    return (points[:-1] if is_curve_closed else points), is_curve_closed
+
 # ===================================================
 # BRep generators based on OCCT
 # ===================================================
 
 def make_cylinder_OCCT(radius = 1.0, height = 1.0, base = [0.0, 0.0, 0.0], direction = [0.0, 0.0, 1.0]):
+    from OCC.Core.BRepPrimAPI import BRepPrimAPI_MakeCylinder
     base_of_cylinder = gp_Pnt(base[0], base[1], base[2])
     direction_of_cylinder = gp_Dir(direction[0], direction[1], direction[2])
     axis_of_cylinder = gp_Ax2(base_of_cylinder, direction_of_cylinder)
@@ -209,6 +1084,7 @@ def make_cylinder_OCCT(radius = 1.0, height = 1.0, base = [0.0, 0.0, 0.0], direc
         print("\t\t\theight      :", height)
         print("\t\t\tbase        :", make_pnt_OCCT_to_string(base_of_cylinder))
         print("\t\t\tdirection   :", make_pnt_OCCT_to_string(direction_of_cylinder))
+    count_instrumented("BRepPrimAPI_MakeCylinder")
     return BRepPrimAPI_MakeCylinder(axis_of_cylinder, radius, height).Shape()
 
 def make_plane_with_normal_and_tangent_OCCT(normal = [0.0, 0.0, 1.0], origin = [0.0, 0.0, 0.0], tangent = [1.0, 0.0, 0.0], length = 1.0):
@@ -232,9 +1108,11 @@ def make_plane_with_normal_and_tangent_OCCT(normal = [0.0, 0.0, 1.0], origin = [
         print("\t\t\tp2 : ", make_pnt_OCCT_to_string(p2))
         print("\t\t\tp3 : ", make_pnt_OCCT_to_string(p3))
         print("\t\t\tp4 : ", make_pnt_OCCT_to_string(p4))
+    count_instrumented("BRepBuilderAPI_MakeFace")
     return BRepBuilderAPI_MakeFace(wire).Face()
 
 def make_circular_face_OCCT(radius = 1.0, origin = [0.0, 0.0, 0.0], normal = [0.0, 0.0, 1.0]):
+    from OCC.Core.GC import GC_MakeCircle
     o = convert_list_to_pnt_OCCT(origin)
     d = convert_list_to_dir_OCCT(normal)
     circle = GC_MakeCircle(gp_Ax2(o, d), radius).Value()
@@ -245,8 +1123,26 @@ def make_circular_face_OCCT(radius = 1.0, origin = [0.0, 0.0, 0.0], normal = [0.
         print("\t\t\torigin    : ", make_pnt_OCCT_to_string(o))
         print("\t\t\tdirection : ", make_dir_OCCT_to_string(d))
         print("\t\t\tradius    : ", radius)
+    count_instrumented("BRepBuilderAPI_MakeFace")
     return BRepBuilderAPI_MakeFace(circle_wire).Face()
 
+def make_arc_face_OCCT(radius = 1.0, origin = [0.0, 0.0, 0.0], normal = [0.0, 0.0, 1.0], x_axis = [1.0, 0.0, 0.0], start_angle = 0.0, angular_span = np.pi):
+    from OCC.Core.gp import gp_Circ
+    # Face bounded by the arc (angles measured from x_axis around normal) and the chord between its ends
+    o = convert_list_to_pnt_OCCT(origin)
+    circle = gp_Circ(gp_Ax2(o, convert_list_to_dir_OCCT(normal), convert_list_to_dir_OCCT(x_axis)), radius)
+    first_angle, last_angle = sorted((start_angle, start_angle + angular_span))
+    arc_edge = BRepBuilderAPI_MakeEdge(circle, first_angle, last_angle)
+    chord_edge = BRepBuilderAPI_MakeEdge(arc_edge.Vertex2(), arc_edge.Vertex1()).Edge()
+    arc_wire = BRepBuilderAPI_MakeWire(arc_edge.Edge(), chord_edge).Wire()
+    if LOG_TO_CONSOLE:
+        print("\t\tCreating plane BRep with (arc)")
+        print("\t\t\torigin    : ", make_pnt_OCCT_to_string(o))
+        print("\t\t\tradius    : ", radius)
+        print("\t\t\tangles    : ", first_angle, last_angle)
+    count_instrumented("BRepBuilderAPI_MakeFace")
+    return BRepBuilderAPI_MakeFace(arc_wire).Face()
+
 def extract_wire_from_shape_OCCT(shape):
     wire_maker = BRepBuilderAPI_MakeWire()
     explorer = TopExp_Explorer(shape, TopAbs_EDGE)
@@ -256,12 +1152,14 @@ def extract_wire_from_shape_OCCT(shape):
     return wire_maker.Wire()
 
 def combine_faces_with_loft_OCCT(face1, face2):
+    from OCC.Core.BRepOffsetAPI import BRepOffsetAPI_ThruSections
     wire1 = extract_wire_from_shape_OCCT(face1)
     wire2 = extract_wire_from_shape_OCCT(face2)
     loft = BRepOffsetAPI_ThruSections(True, True)
     loft.AddWire(wire1)
     loft.AddWire(wire2)
-    loft.Build()
+    with instrument("BRepOffsetAPI_ThruSections", "occt"):
+        loft.Build()
     return loft.Shape()
 
 def make_domain_OCCT(size = 1.0):
@@ -289,8 +1187,164 @@ def make_domain_OCCT(size = 1.0):
     return edges
 
 def make_curve_OCCT(points, lines):
+    count_instrumented("BRepBuilderAPI_MakeEdge", len(lines))
     return [BRepBuilderAPI_MakeEdge(gp_Pnt(*points[line[0]]), gp_Pnt(*points[line[1]])).Edge() for line in lines]
 
+def make_polygon_wire_OCCT(points, closed = False):
+    count_instrumented("BRepBuilderAPI_MakePolygon")
+    polygon = BRepBuilderAPI_MakePolygon()
+    for point in points:
+        polygon.Add(gp_Pnt(*point))
+    if closed:
+        polygon.Close()
+    return polygon.Wire()
+
+def make_bspline_edge_OCCT(points, closed = False, tolerance = ARITHMETIC_TOLERANCE):
+    from OCC.Core.TColgp import TColgp_Array1OfPnt
+    from OCC.Core.GeomAPI import GeomAPI_PointsToBSpline
+    from OCC.Core.GeomAbs import GeomAbs_C2
+    # Approximation through the points, a closed curve ends on its first point
+    if closed:
+        points = np.vstack([points, points[:1]])
+    array = TColgp_Array1OfPnt(1, len(points))
+    for index, point in enumerate(points):
+        array.SetValue(index + 1, gp_Pnt(*point))
+    count_instrumented("GeomAPI_PointsToBSpline")
+    approximation = GeomAPI_PointsToBSpline(array, 3, 8, GeomAbs_C2, tolerance)
+    if not approximation.IsDone():
+        return make_polygon_wire_OCCT(points[:-1] if closed else points, closed)
+    return BRepBuilderAPI_MakeEdge(approximation.Curve()).Edge()
+
+# ===================================================
+# Boolean operations based on OCCT
+# ===================================================
+
+def make_boolean_options(tolerances = [], glue = 'off'):
+    # Fuzzy value from the err of the primitives whose faces take part in the operation, glue for arguments known to share faces
+    options = BooleanOptions()
+    options.fuzzy_value = BOOLEAN_FUZZY_FACTOR * max(tolerances, default=0.0)
+    options.glue = glue
+    return options
+
+def run_boolean_attempt_OCCT(operation, argument_shapes : list, tool_shapes : list, options : BooleanOptions, is_fallback = False):
+    from OCC.Core.BRepAlgoAPI import BRepAlgoAPI_Common, BRepAlgoAPI_Fuse
+    from OCC.Core.BOPAlgo import BOPAlgo_GlueOff, BOPAlgo_GlueShift, BOPAlgo_GlueFull
+    from OCC.Core.BRepCheck import BRepCheck_Analyzer
+    from OCC.Core.TopTools import TopTools_ListOfShape
+    if operation == 'fuse':
+        name = "BRepAlgoAPI_Fuse"
+        builder = BRepAlgoAPI_Fuse()
+    else:
+        name = "BRepAlgoAPI_Common"
+        builder = BRepAlgoAPI_Common()
+    arguments = TopTools_ListOfShape()
+    for shape in argument_shapes:
+        arguments.Append(shape)
+    tools = TopTools_ListOfShape()
+    for shape in tool_shapes:
+        tools.Append(shape)
+    builder.SetArguments(arguments)
+    builder.SetTools(tools)
+    builder.SetRunParallel(options.parallel)
+    builder.SetFuzzyValue(options.fuzzy_value)
+    builder.SetGlue({'off': BOPAlgo_GlueOff, 'shift': BOPAlgo_GlueShift, 'full': BOPAlgo_GlueFull}[options.glue])
+    start = time.perf_counter()
+    builder.Build()
+    end = time.perf_counter()
+    shape = builder.Shape() if builder.IsDone() and not builder.HasErrors() else None
+    is_valid = shape is not None and (not boolean_check_validity or BRepCheck_Analyzer(shape).IsValid())
+    record_instrumented_event(name, "occt", start, end, shapes=len(argument_shapes) + len(tool_shapes), fuzzy_value=options.fuzzy_value, glue=options.glue, fallback=is_fallback, valid=is_valid, checked=boolean_check_validity)
+    if LOG_TO_CONSOLE:
+        print(f"{name} of {len(argument_shapes) + len(tool_shapes)} shapes with fuzzy value {options.fuzzy_value:g} and glue {options.glue} took {end - start:.4f}s, valid {is_valid}")
+    return shape, is_valid
+
+def run_boolean_OCCT(operation, argument_shapes : list, tool_shapes : list, options = None):
+    # operation is 'fuse' or 'common'. The fast mode given by options (fuzzy value, glue) runs first, when it fails or its result
+    # is not valid the operation runs again in the strict mode (no fuzzy value, no glue). None is returned when the strict mode fails too
+    strict_options = BooleanOptions()
+    is_fast_mode = boolean_fast_mode and options is not None and (options.fuzzy_value > 0.0 or options.glue != 'off')
+    if is_fast_mode:
+        shape, is_valid = run_boolean_attempt_OCCT(operation, argument_shapes, tool_shapes, options)
+        if is_valid:
+            return shape
+        print(f"Boolean {operation} with fuzzy value {options.fuzzy_value:g} and glue {options.glue} failed, falling back to the strict mode")
+        count_instrumented("boolean fallbacks")
+    shape, is_valid = run_boolean_attempt_OCCT(operation, argument_shapes, tool_shapes, strict_options, is_fast_mode)
+    if not is_valid:
+        print(f"Boolean {operation} of {len(argument_shapes) + len(tool_shapes)} shapes", "failed" if shape is None else "gave an invalid shape")
+    return shape
+
+def fuse_pair_OCCT(shape1, shape2, options = None):
+    # A fuse failing in both modes would drop its two arguments from the result (and from the incremental state), the run stops instead
+    shape = run_boolean_OCCT('fuse', [shape1], [shape2], options)
+    if shape is None:
+        print("Fuse failed in the fast and strict modes, stopping")
+        exit(-1)
+    return shape
+
+def fuse_shapes_linear_OCCT(shapes : list, tolerances : list, glue = 'off'):
+    combined = shapes[0]
+    combined_tolerance = tolerances[0]
+    for shape, tolerance in zip(shapes[1:], tolerances[1:]):
+        combined = fuse_pair_OCCT(combined, shape, make_boolean_options([combined_tolerance, tolerance], glue))
+        combined_tolerance = max(combined_tolerance, tolerance)
+    return combined
+
+def fuse_shapes_tree_OCCT(shapes : list, tolerances : list, glue = 'off'):
+    # Pairwise reduction (0 + 1), (2 + 3), ... level by level, so every fuse works on shapes of similar complexity
+    level = list(zip(shapes, tolerances))
+    while len(level) > 1:
+        next_level = []
+        for index in range(0, len(level) - 1, 2):
+            (shape1, tolerance1), (shape2, tolerance2) = level[index], level[index + 1]
+            next_level.append((fuse_pair_OCCT(shape1, shape2, make_boolean_options([tolerance1, tolerance2], glue)), max(tolerance1, tolerance2)))
+        if len(level) % 2 == 1:
+            next_level.append(level[-1])
+        level = next_level
+    return level[0][0]
+
+def fuse_shapes_multi_OCCT(shapes : list, tolerances : list, glue = 'off'):
+    # Single general fuse with the first shape as argument and the rest as tools
+    shape = run_boolean_OCCT('fuse', shapes[:1], shapes[1:], make_boolean_options(tolerances, glue))
+    if shape is None:
+        print("Multi-argument fuse failed, falling back to tree fuse")
+        return fuse_shapes_tree_OCCT(shapes, tolerances, glue)
+    return shape
+
+def fuse_shapes_OCCT(shapes : list, strategy = FUSE_STRATEGY, tolerances = None, glue = 'off'):
+    # Strategy 'compare' runs every strategy, reports their timing and returns the result of the fastest one
+    # tolerances holds for every shape the largest err of the primitives it comes from, the options of every fuse are made from the
+    # tolerances of its own arguments and its result carries the largest of them to the next fuse, without tolerances there is no fuzzy value
+    if tolerances is None:
+        tolerances = [0.0] * len(shapes)
+    tolerances = [tolerance for shape, tolerance in zip(shapes, tolerances) if shape is not None]
+    shapes = [shape for shape in shapes if shape is not None]
+    if len(shapes) == 0:
+        return None
+    if len(shapes) == 1:
+        return shapes[0]
+    strategies = FUSE_STRATEGIES if strategy == 'compare' else (strategy,)
+    fastest_shape = None
+    fastest_time = sys.float_info.max
+    for fuse_strategy in strategies:
+        start = time.perf_counter()
+        if fuse_strategy == 'linear':
+            shape = fuse_shapes_linear_OCCT(shapes, tolerances, glue)
+        elif fuse_strategy == 'tree':
+            shape = fuse_shapes_tree_OCCT(shapes, tolerances, glue)
+        elif fuse_strategy == 'multi':
+            shape = fuse_shapes_multi_OCCT(shapes, tolerances, glue)
+        else:
+            print("Unknown fuse strategy", fuse_strategy)
+            exit(-1)
+        elapsed = time.perf_counter() - start
+        if LOG_TO_CONSOLE or strategy == 'compare':
+            print(f"Fuse of {len(shapes)} shapes with strategy {fuse_strategy} took {elapsed:.4f}s")
+        if elapsed < fastest_time:
+            fastest_shape = shape
+            fastest_time = elapsed
+    return fastest_shape
+
 # ===================================================
 # Trimming operations
 # ===================================================
@@ -300,7 +1354,8 @@ def trim_cylinder(curve : Curve, cylinder : Cylinder, plane : Plane):
     N = convert_list_to_vec3_OCCT(plane.normal)
     if are_vectors_parallel_with_OCCT(D, N):
         P0 = convert_list_to_vec3_OCCT(cylinder.base)
-        P = convert_list_to_vec3_OCCT(curve.points[0])
+        fit = fit_curve(curve, err=max(cylinder.tolerance, plane.tolerance))
+        P = convert_list_to_vec3_OCCT(fit.center if fit.kind != 'line' else curve.points[0])
         d = normalize_normal_with_OCCT(cylinder.direction)
         signed_distance = (P - P0).Dot(d)
         if signed_distance < 0:
@@ -308,7 +1363,7 @@ def trim_cylinder(curve : Curve, cylinder : Cylinder, plane : Plane):
         cylinder_height = abs(signed_distance)
         return make_cylinder_OCCT(cylinder.radius, cylinder_height, cylinder.base, convert_vec3_OCCT_to_list(d))
     else:
-        radius, center_of_mass = make_circle_from_curve(curve)
+        radius, center_of_mass = make_circle_from_curve(curve, max(cylinder.tolerance, plane.tolerance))
         face1 = make_circular_face_OCCT(radius, convert_vec3_OCCT_to_list(center_of_mass), plane.normal)
         face2 = make_circular_face_OCCT(radius, cylinder.base, cylinder.direction)
         return combine_faces_with_loft_OCCT(face1, face2)
@@ -316,14 +1371,17 @@ def trim_cylinder(curve : Curve, cylinder : Cylinder, plane : Plane):
 def trim_plane(curve : Curve, plane : Plane):
     is_curve_closed = (len(curve.start_end) == 0)
     if is_curve_closed:
-        radius, curve_center_of_mass = make_circle_from_curve(curve)
+        radius, curve_center_of_mass = make_circle_from_curve(curve, plane.tolerance)
         return make_circular_face_OCCT(radius, convert_vec3_OCCT_to_list(curve_center_of_mass), plane.normal), curve_center_of_mass
     else:
-        P1 = convert_list_to_vec3_OCCT(curve.points[curve.start_end[0]])
-        P2 = convert_list_to_vec3_OCCT(curve.points[curve.start_end[1]])
+        fit = fit_curve(curve, err=plane.tolerance)
+        P1 = convert_list_to_vec3_OCCT(fit.start)
+        P2 = convert_list_to_vec3_OCCT(fit.end)
         tangent = (P1 - P2)
         curve_length = tangent.Magnitude()
         curve_center_of_mass = multiply_vec3_OCCT_with_scalar((P1 + P2), 0.5)
+        if fit.kind == 'arc':
+            return make_arc_face_OCCT(fit.radius, list(fit.center), list(fit.normal), list(fit.x_axis), fit.start_angle, fit.angular_span), curve_center_of_mass
         return make_plane_with_normal_and_tangent_OCCT(
                 plane.normal, 
                 convert_vec3_OCCT_to_list(curve_center_of_mass), 
@@ -348,7 +1406,7 @@ def trim(curve : Curve, primitives : list):
         elif (isinstance(primitive1, Plane) and isinstance(primitive2, Plane)):
             face1, face1_center  = trim_plane(curve, primitive1)
             face2, face2_center = trim_plane(curve, primitive2)
-            return [[face1, primitive1.normal, face1_center], [face2, primitive2.normal, face2_center]]
+            return [make_planar_face(curve, primitive1, face1, face1_center), make_planar_face(curve, primitive2, face2, face2_center)]
     elif (number_of_primitives == 3):
         cylinders_indices = []
         plane_index = -1
@@ -369,118 +1427,514 @@ def trim(curve : Curve, primitives : list):
         print("Trim operation for", number_of_primitives, "primitives not supported")
     return None
 
-def trim_collect_shapes_that_are_in_the_same_plane(trimmed_shapes):
-    shapes_in_same_plane = {}
+def make_planar_face(curve : Curve, plane : Plane, face, center : gp_Vec):
+    planar_face = PlanarFace()
+    planar_face.face = face
+    planar_face.normal = tuple(plane.normal)
+    planar_face.distance_to_origin = plane.distance_to_origin
+    planar_face.tolerance = plane.tolerance
+    planar_face.center = tuple(convert_vec3_OCCT_to_list(center))
+    if len(curve.start_end) == 2:
+        planar_face.tangent = tuple(np.asarray(curve.points[curve.start_end[0]], dtype=np.float64) - np.asarray(curve.points[curve.start_end[1]], dtype=np.float64))
+    return planar_face
+
+def canonicalize_plane(normal, distance_to_origin):
+    # Unit normal with its largest component positive, so opposite-facing normals of the same plane usually fall in the same cell
+    normal = np.asarray(normal, dtype=np.float64)
+    length = np.linalg.norm(normal)
+    if length > 0.0:
+        normal = normal / length
+        distance_to_origin = distance_to_origin / length
+    if normal[np.argmax(np.abs(normal))] < 0.0:
+        normal = -normal
+        distance_to_origin = -distance_to_origin
+    return normal, distance_to_origin
+
+def cluster_planar_faces(planar_faces : list, tolerance = ARITHMETIC_TOLERANCE):
+    # Planes are hashed by their quantized (normal, distance), with cells as large as the largest tolerance,
+    # so a plane only needs to be compared against the clusters of the neighbouring cells
+    if len(planar_faces) == 0:
+        return []
+    cell_size = tolerance + max(planar_face.tolerance for planar_face in planar_faces)
+    cells = {}
+    clusters = []
+    for planar_face in planar_faces:
+        normal, distance_to_origin = canonicalize_plane(planar_face.normal, planar_face.distance_to_origin)
+        face_tolerance = tolerance + planar_face.tolerance
+        found_cluster = None
+        # The sign of canonicalize_plane is unstable when two components of the normal are almost equal, both orientations are tested
+        for oriented_normal, oriented_distance in ((normal, distance_to_origin), (-normal, -distance_to_origin)):
+            key = np.floor(np.append(oriented_normal, oriented_distance) / cell_size).astype(np.int64)
+            for offset in np.ndindex(3, 3, 3, 3):
+                for cluster_index in cells.get(tuple(key + np.asarray(offset) - 1), ()):
+                    cluster_normal, cluster_distance, cluster_tolerance, _ = clusters[cluster_index]
+                    maximum_tolerance = max(face_tolerance, cluster_tolerance)
+                    if np.linalg.norm(oriented_normal - cluster_normal) <= maximum_tolerance and abs(oriented_distance - cluster_distance) <= maximum_tolerance:
+                        found_cluster = cluster_index
+                        break
+                if found_cluster is not None:
+                    break
+            if found_cluster is not None:
+                break
+        if found_cluster is None:
+            found_cluster = len(clusters)
+            clusters.append((normal, distance_to_origin, face_tolerance, []))
+            key = np.floor(np.append(normal, distance_to_origin) / cell_size).astype(np.int64)
+            cells.setdefault(tuple(key), []).append(found_cluster)
+        clusters[found_cluster][3].append(planar_face)
+    return [cluster[3] for cluster in clusters]
+
+def compute_bounding_box_OCCT(shape, gap = 0.0):
+    box = Bnd_Box()
+    brepbndlib.Add(shape, box)
+    box.SetGap(gap)
+    return box
+
+def trim_collect_shapes_that_are_in_the_same_plane(trimmed_shapes, tolerance = ARITHMETIC_TOLERANCE):
+    # Faces of curves on the same plane are intersected pairwise, only for curves that are not parallel
+    # (those bound the face in the other direction) and whose faces have overlapping bounding boxes
+    # Returns the intersections and the largest err of the two planes of each one (the tolerances of fuse_shapes_OCCT)
+    planar_faces = []
     for trimmed_shape in trimmed_shapes:
         if isinstance(trimmed_shape, list):
-            for face_with_normal in trimmed_shape:
-                normal = face_with_normal[1]
-                hash_normal_key = hash(tuple(normal))
-                if hash_normal_key not in shapes_in_same_plane:
-                    shapes_in_same_plane[hash_normal_key] = []
-                shapes_in_same_plane[hash_normal_key].append([face_with_normal[0], face_with_normal[2]])
+            planar_faces.extend(trimmed_shape)
     collected_trimmed_shapes = []
-    for value in shapes_in_same_plane.values():
-        if (len(value) == 4):
-            max_distance_between_faces_index = -1
-            max_distance_between_faces_value = sys.float_info.min
-            for face_index, face in enumerate(value):
-                distance_between_faces = (value[0][1] - face[1]).Magnitude()
-                if (distance_between_faces > max_distance_between_faces_value):
-                    max_distance_between_faces_value = distance_between_faces
-                    max_distance_between_faces_index = face_index
-            other_faces_indices = []
-            if max_distance_between_faces_index == 1:
-                other_faces_indices.extend([2, 3])
-            if max_distance_between_faces_index == 2:
-                other_faces_indices.extend([1, 3])
-            if max_distance_between_faces_index == 3:
-                other_faces_indices.extend([1, 2])
-            for other_face_index in other_faces_indices:
-                trimmed_shape1 = BRepAlgoAPI_Common(value[0][0], value[other_face_index][0]).Shape()
-                trimmed_shape2 = BRepAlgoAPI_Common(value[max_distance_between_faces_index][0], value[other_face_index][0]).Shape()
-                combined = BRepAlgoAPI_Fuse(trimmed_shape1, trimmed_shape2).Shape()
-                collected_trimmed_shapes.append(combined)
-    return collected_trimmed_shapes
-
-def trim_curve_with_primitive(curve : Curve, primitives : list):
+    collected_tolerances = []
+    for cluster in cluster_planar_faces(planar_faces, tolerance):
+        if len(cluster) < 2:
+            continue
+        bounding_boxes = [compute_bounding_box_OCCT(planar_face.face, tolerance) for planar_face in cluster]
+        for first_index in range(len(cluster)):
+            for second_index in range(first_index + 1, len(cluster)):
+                first = cluster[first_index]
+                second = cluster[second_index]
+                if first.tangent is None or second.tangent is None:
+                    continue
+                first_tangent = np.asarray(first.tangent) / np.linalg.norm(first.tangent)
+                second_tangent = np.asarray(second.tangent) / np.linalg.norm(second.tangent)
+                if np.linalg.norm(np.cross(first_tangent, second_tangent)) <= tolerance:
+                    continue
+                if bounding_boxes[first_index].IsOut(bounding_boxes[second_index]):
+                    count_instrumented("BRepAlgoAPI_Common skipped")
+                    continue
+                common = run_boolean_OCCT('common', [first.face], [second.face], make_boolean_options([first.tolerance, second.tolerance]))
+                if common is not None:
+                    collected_trimmed_shapes.append(common)
+                    collected_tolerances.append(max(first.tolerance, second.tolerance))
+    return collected_trimmed_shapes, collected_tolerances
+
+def trim_curve_with_primitive(curve : Curve, primitives : list, classify = True, cache = None):
     find_start_end_of_curve(curve)
-    find_primitives_for_curve(curve, primitives)
+    if classify:
+        find_primitives_for_curve(curve, primitives)
     if (len(curve.primitives) != 0):
         if LOG_TO_CONSOLE:
             is_curve_closed = (len(curve.start_end) == 0)
             print("Curve", curve.index, "(", is_curve_closed, ") has primitves :", *curve.primitives)
             for primitive_index in curve.primitives:
                 print(primitives[primitive_index])
-        trimmed_shape = trim(curve, primitives)
+        if cache is not None:
+            trimmed_shape = trim_with_shape_cache(curve, primitives, cache)
+        else:
+            trimmed_shape = trim(curve, primitives)
         if trimmed_shape is not None:
             return trimmed_shape
     else:
         print("Error finding primitives for curve ", curve.index)
     return None
 
-def trim_cube(edges, primitives):
-    # Face 1 [2, 3, 4, 5] - Front
-    # Face 2 [9, 12, 20, 21] - Back
-    # Face 3 [2, 8, 9, 10] - Top
-    # Face 4 [3, 11, 12, 13] - Bottom
-    # Face 5 [4, 8, 11, 20] - Right
-    # Face 6 [10, 13, 21, 5] - Left
-    cube_planes = []
-    cube_faces = \
-    [
-        [2, 3, 4, 5],
-        [9, 12, 20, 21],
-        [2, 8, 9, 10],
-        [3, 11, 12, 13],
-        [4, 8, 11, 20],
-        [10, 13, 21, 5],
-    ]
-    for cube_face in cube_faces:
+def trim_curves_with_primitive(curves : list, primitives : list, workers = 1, cache = None):
+    # Results keep the order of curves, with workers > 1 the curves are trimmed in a process pool
+    if workers <= 1 or len(curves) <= 1:
         trimmed_shapes = []
-        for cube_edge in cube_face:
-            curve = edges['curves'][cube_edge]
-            curve_as_object = Curve()
-            curve_as_object.points = curve['pv_points']
-            curve_as_object.lines = curve['pv_lines']
-            curve_as_object.index = cube_edge
-            trimmed_shapes.append(trim_curve_with_primitive(curve_as_object, primitives))
-        trim_in_same_plane = trim_collect_shapes_that_are_in_the_same_plane(trimmed_shapes)
-        combined = BRepAlgoAPI_Fuse(trim_in_same_plane[0], trim_in_same_plane[1]).Shape()
-        cube_planes.append(combined)
-    front_and_back_planes = BRepAlgoAPI_Fuse(cube_planes[0], cube_planes[1]).Shape()
-    top_and_bottom_planes = BRepAlgoAPI_Fuse(cube_planes[2], cube_planes[3]).Shape()
-    right_and_left_planes = BRepAlgoAPI_Fuse(cube_planes[4], cube_planes[5]).Shape()
-    cube = BRepAlgoAPI_Fuse(BRepAlgoAPI_Fuse(front_and_back_planes, top_and_bottom_planes).Shape(), right_and_left_planes).Shape()
-    return cube, list(set(num for sublist in cube_faces for num in sublist))
-
-def trim_object(edges, primitives):
-    primitives_as_object = collect_primitives_as_objects(primitives)
-    combined_cube, cube_indices = trim_cube(edges, primitives_as_object)
+        for curve in curves:
+            with instrument("trim_curve_with_primitive", "curve", curve=curve.index):
+                trimmed_shapes.append(trim_curve_with_primitive(curve, primitives, classify=False, cache=cache))
+        return trimmed_shapes
+    trimmed_shapes = []
+    chunk_size = max(1, len(curves) // (workers * 4))
+    cache_settings = None if cache is None else (cache.directory, cache.memory_entries, cache.disk_bytes)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(PROCESS_START_METHOD), initializer=initialize_trim_worker, initargs=(primitives, cache_settings, instrumentation is not None)) as executor:
+        for output, serialized_shape, cache_counters, worker_instrumentation in executor.map(trim_curve_in_worker, curves, chunksize=chunk_size):
+            if output:
+                print(output, end='')
+            trimmed_shapes.append(deserialize_trimmed_shape_OCCT(serialized_shape))
+            merge_instrumentation_of_worker(worker_instrumentation)
+            if cache is not None:
+                cache.memory_hits += cache_counters[0]
+                cache.disk_hits += cache_counters[1]
+                cache.misses += cache_counters[2]
+    return trimmed_shapes
+
+def trim_cube(trimmed_shapes : list, topology : TopologyIndex, fuse_strategy = FUSE_STRATEGY, incremental = None, keys = None):
+    # With incremental the face loops and the fusion tree of the cube are keyed by the keys of their curves and reused when unchanged
+    # The planes of the cube only share edges, they are fused with the glue option
+    cube_planes = []
+    cube_plane_tolerances = []
+    cube_plane_keys = []
+    for _, face_loop in topology.face_loops:
+        face_loop_shapes = [trimmed_shapes[curve_index] for curve_index in face_loop]
+        cube_plane_tolerances.append(max((planar_face.tolerance for trimmed_shape in face_loop_shapes if isinstance(trimmed_shape, list) for planar_face in trimmed_shape), default=0.0))
+        if incremental is None:
+            cube_planes.append(trim_face_loop(face_loop_shapes, fuse_strategy))
+        else:
+            key = combine_incremental_keys('face_loop', [keys[curve_index] for curve_index in face_loop])
+            cube_planes.append(reuse_or_compute_incremental(incremental, 'face_loop', key, trim_face_loop, face_loop_shapes, fuse_strategy))
+            cube_plane_keys.append(key)
+    if incremental is None:
+        cube = fuse_shapes_OCCT(cube_planes, fuse_strategy, cube_plane_tolerances, 'shift')
+    else:
+        cube = fuse_shapes_incremental_OCCT(cube_planes, cube_plane_keys, incremental, cube_plane_tolerances, 'shift')
+    return cube, topology.face_loop_curves
+
+def trim_face_loop(face_loop_shapes : list, fuse_strategy = FUSE_STRATEGY):
+    trim_in_same_plane, tolerances = trim_collect_shapes_that_are_in_the_same_plane(face_loop_shapes)
+    return fuse_shapes_OCCT(trim_in_same_plane, fuse_strategy, tolerances)
+
+def is_trimmed_shape_of_cylinders(curve : Curve, trimmed_shape):
+    # Curves lying on two planes give lists of PlanarFace, which only make sense in the face loops of the cube
+    if isinstance(trimmed_shape, list):
+        print("Curve", curve.index, "lies on two planes outside every face loop, skipped")
+        return False
+    return True
+
+def compute_tolerance_of_curve(curve : Curve, primitives : list):
+    # Largest err of the primitives of the curve, the tolerance of its trimmed shape in the fuses
+    return max((primitives[primitive_index].tolerance for primitive_index in curve.primitives), default=0.0)
+
+def classify_curves_and_build_topology(edges, primitives):
+    # primitives is the list read from surface_info.json or the result of collect_primitives_as_objects (the trimming service caches it)
+    primitives_as_object = primitives if len(primitives) > 0 and isinstance(primitives[0], Primitive) else collect_primitives_as_objects(primitives)
+    curves_as_object = collect_curves_as_objects(edges)
+    with instrument("classification"):
+        grid = None
+        if len(primitives_as_object) >= GRID_MINIMUM_PRIMITIVES:
+            points, _ = collect_curves_points_as_array(curves_as_object)
+            grid = build_primitive_grid(primitives_as_object, points)
+        find_primitives_for_curves(curves_as_object, primitives_as_object, grid=grid)
+    with instrument("build_topology_index"):
+        topology = build_topology_index(curves_as_object, primitives_as_object, edges.get('corners', []))
+    return curves_as_object, primitives_as_object, topology
+
+def trim_object(edges, primitives, fuse_strategy = FUSE_STRATEGY, workers = 1, cache = None, on_component = None, incremental = None, classification = None):
+    # classification is the result of classify_curves_and_build_topology when the caller already has it
+    curves_as_object, primitives_as_object, topology = classification or classify_curves_and_build_topology(edges, primitives)
+    keys = None
+    with instrument("trim_curves_with_primitive", workers=workers):
+        if incremental is None:
+            trimmed_shapes = trim_curves_with_primitive(curves_as_object, primitives_as_object, workers, cache)
+        else:
+            trimmed_shapes, keys = trim_curves_incremental(curves_as_object, primitives_as_object, incremental, workers, cache)
+    with instrument("trim_cube"):
+        combined_cube, cube_indices = trim_cube(trimmed_shapes, topology, fuse_strategy, incremental, keys)
+    if on_component is not None:
+        on_component(combined_cube, 'cube')
     trimmed_cylinders = []
-    for curve_index, curve in enumerate(edges['curves']):
-        if (curve_index not in cube_indices):
-            curve_as_object = Curve()
-            curve_as_object.points = curve['pv_points']
-            curve_as_object.lines = curve['pv_lines']
-            curve_as_object.index = curve_index
-            trimmed_cylinders.append(trim_curve_with_primitive(curve_as_object, primitives_as_object))
-    combined_cylinders = None
-    if len(trimmed_cylinders) != 0:
-        combined_cylinders = trimmed_cylinders[0]
-        for trimmed_shape in trimmed_cylinders[1:]: 
-            combined_cylinders = BRepAlgoAPI_Fuse(combined_cylinders, trimmed_shape).Shape()
+    trimmed_cylinder_keys = []
+    cylinder_tolerances = []
+    for curve_index, trimmed_shape in enumerate(trimmed_shapes):
+        if (curve_index not in cube_indices) and is_trimmed_shape_of_cylinders(curves_as_object[curve_index], trimmed_shape):
+            trimmed_cylinders.append(trimmed_shape)
+            cylinder_tolerances.append(compute_tolerance_of_curve(curves_as_object[curve_index], primitives_as_object))
+            if keys is not None:
+                trimmed_cylinder_keys.append(keys[curve_index])
+    with instrument("fuse_cylinders"):
+        if incremental is None:
+            combined_cylinders = fuse_shapes_OCCT(trimmed_cylinders, fuse_strategy, cylinder_tolerances)
+        else:
+            combined_cylinders = fuse_shapes_incremental_OCCT(trimmed_cylinders, trimmed_cylinder_keys, incremental, cylinder_tolerances)
+    if on_component is not None:
+        on_component(combined_cylinders, 'cylinders')
     builder = BRep_Builder()
     result_compound = TopoDS_Compound()
     builder.MakeCompound(result_compound)
-    builder.Add(result_compound, combined_cube)
-    builder.Add(result_compound, combined_cylinders)
+    if combined_cube is not None:
+        builder.Add(result_compound, combined_cube)
+    if combined_cylinders is not None:
+        builder.Add(result_compound, combined_cylinders)
+    if incremental is not None:
+        finish_incremental_run(incremental)
     return result_compound
 
+# ===================================================
+# Parallel trimming
+# ===================================================
+
+def serialize_shape_OCCT(shape):
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "shape.brep")
+        breptools.Write(shape, file_name)
+        with open(file_name, 'rb') as file:
+            return file.read()
+
+def deserialize_shape_OCCT(data : bytes):
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "shape.brep")
+        with open(file_name, 'wb') as file:
+            file.write(data)
+        shape = TopoDS_Shape()
+        breptools.Read(shape, file_name, BRep_Builder())
+        return shape
+
+def serialize_trimmed_shape_OCCT(trimmed_shape):
+    # trim returns None, a shape, or a list of PlanarFace for curves between two planes
+    if trimmed_shape is None:
+        return None
+    if isinstance(trimmed_shape, list):
+        return [[serialize_shape_OCCT(planar_face.face)] + [getattr(planar_face, name) for name in PlanarFace.__slots__[1:]] for planar_face in trimmed_shape]
+    return serialize_shape_OCCT(trimmed_shape)
+
+def deserialize_trimmed_shape_OCCT(serialized_shape):
+    if serialized_shape is None:
+        return None
+    if isinstance(serialized_shape, list):
+        planar_faces = []
+        for serialized_planar_face in serialized_shape:
+            planar_face = PlanarFace()
+            planar_face.face = deserialize_shape_OCCT(serialized_planar_face[0])
+            for name, value in zip(PlanarFace.__slots__[1:], serialized_planar_face[1:]):
+                setattr(planar_face, name, value)
+            planar_faces.append(planar_face)
+        return planar_faces
+    return deserialize_shape_OCCT(serialized_shape)
+
+worker_primitives = None
+worker_cache = None
+
+def initialize_trim_worker(primitives : list, cache_settings = None, instrumented = False):
+    # Every worker has its own memory cache in front of the shared disk cache, and its own instrumentation sent back with every curve
+    global worker_primitives, worker_cache
+    worker_primitives = primitives
+    if cache_settings is not None:
+        worker_cache = make_shape_cache(*cache_settings)
+    if instrumented:
+        enable_instrumentation()
+
+def trim_curve_in_worker(curve : Curve):
+    # The console output is sent back so the parent prints it in the order of the curves
+    output = io.StringIO()
+    cache_counters = (0, 0, 0) if worker_cache is None else (worker_cache.memory_hits, worker_cache.disk_hits, worker_cache.misses)
+    with contextlib.redirect_stdout(output):
+        with instrument("trim_curve_with_primitive", "curve", curve=curve.index):
+            trimmed_shape = trim_curve_with_primitive(curve, worker_primitives, classify=False, cache=worker_cache)
+        serialized_shape = serialize_trimmed_shape_OCCT(trimmed_shape)
+    if worker_cache is not None:
+        cache_counters = (worker_cache.memory_hits - cache_counters[0], worker_cache.disk_hits - cache_counters[1], worker_cache.misses - cache_counters[2])
+    return output.getvalue(), serialized_shape, cache_counters, take_instrumentation_of_worker()
+
+# ===================================================
+# Cache of trimmed shapes
+# ===================================================
+
+def make_shape_cache(directory = None, memory_entries = SHAPE_CACHE_MEMORY_ENTRIES, disk_bytes = SHAPE_CACHE_DISK_BYTES):
+    # Without directory only the in-memory LRU is used
+    cache = ShapeCache()
+    cache.directory = directory
+    cache.memory_entries = memory_entries
+    cache.disk_bytes = disk_bytes
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+        update_shape_cache_disk_usage(cache, rescan=True)
+    return cache
+
+def compute_shape_cache_key(curve : Curve, primitives : list):
+    # Everything trim reads : the points and lines of the curve, the participating primitives and the tolerance
+    hasher = hashlib.sha256()
+    hasher.update(repr((SHAPE_CACHE_VERSION, ARITHMETIC_TOLERANCE)).encode('utf-8'))
+    hasher.update(np.ascontiguousarray(curve.points, dtype=np.float64).tobytes())
+    hasher.update(np.ascontiguousarray(curve.lines, dtype=np.int32).tobytes())
+    for primitive_index in curve.primitives:
+        primitive = primitives[primitive_index]
+        if isinstance(primitive, Plane):
+            parameters = ('plane', tuple(primitive.normal), primitive.distance_to_origin)
+        elif isinstance(primitive, Cylinder):
+            parameters = ('cylinder', tuple(primitive.direction), tuple(primitive.base), primitive.radius)
+        else:
+            parameters = ('primitive',)
+        hasher.update(repr((parameters, primitive.tolerance)).encode('utf-8'))
+    return hasher.hexdigest()
+
+def add_to_shape_cache_memory(cache : ShapeCache, key, trimmed_shape):
+    cache.memory[key] = trimmed_shape
+    cache.memory.move_to_end(key)
+    while len(cache.memory) > cache.memory_entries:
+        cache.memory.popitem(last=False)
+
+@contextlib.contextmanager
+def lock_shape_cache(cache : ShapeCache):
+    # The trim workers and other runs share the directory, its usage is updated and entries evicted by one process at a time
+    # (advisory lock where fcntl is available)
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(os.path.join(cache.directory, SHAPE_CACHE_LOCK_FILE), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def evict_from_shape_cache_disk(cache : ShapeCache):
+    # Called under lock_shape_cache, returns the bytes used once done. Stale temporary files are removed, then the least recently used
+    # entries until the usage is below the limit, hits refresh the modification time of their description, BRep files without one go first
+    entries = {}
+    disk_bytes_used = 0
+    now = time.time()
+    for entry in os.scandir(cache.directory):
+        try:
+            stat = entry.stat()
+            if entry.name.endswith(".tmp"):
+                if now - stat.st_mtime > SHAPE_CACHE_STALE_SECONDS:
+                    os.remove(entry.path)
+                else:
+                    disk_bytes_used += stat.st_size
+            elif entry.name.endswith(SHAPE_CACHE_FILE_SUFFIXES):
+                entries.setdefault(entry.name.split('.', 1)[0], []).append((entry.path, stat))
+                disk_bytes_used += stat.st_size
+        except FileNotFoundError:
+            pass
+    def last_use(files):
+        return max((stat.st_mtime for path, stat in files if path.endswith(".json")), default=0.0)
+    for files in sorted(entries.values(), key=last_use):
+        if disk_bytes_used <= cache.disk_bytes:
+            break
+        # The description goes first so no other process reads an entry missing its faces
+        for path, stat in sorted(files, key=lambda file: not file[0].endswith(".json")):
+            try:
+                os.remove(path)
+                disk_bytes_used -= stat.st_size
+            except FileNotFoundError:
+                pass
+    return disk_bytes_used
+
+def update_shape_cache_disk_usage(cache : ShapeCache, added_bytes = 0, rescan = False):
+    # The usage file holds the bytes written by every process, a missing or partial one (killed process) is rebuilt by a scan
+    usage_file_name = os.path.join(cache.directory, SHAPE_CACHE_USAGE_FILE)
+    with lock_shape_cache(cache):
+        disk_bytes_used = None
+        if not rescan:
+            try:
+                with open(usage_file_name) as file:
+                    disk_bytes_used = int(file.read()) + added_bytes
+            except (FileNotFoundError, ValueError):
+                pass
+        if disk_bytes_used is None or disk_bytes_used > cache.disk_bytes:
+            disk_bytes_used = evict_from_shape_cache_disk(cache)
+        with open(usage_file_name, 'w') as file:
+            file.write(str(disk_bytes_used))
+    cache.disk_bytes_used = disk_bytes_used
+
+def write_shape_cache_file(cache : ShapeCache, file_name, data : bytes):
+    # Written to a temporary file first so other processes never read a partial file, returns the bytes written
+    with tempfile.NamedTemporaryFile('wb', dir=cache.directory, suffix=".tmp", delete=False) as file:
+        file.write(data)
+        temporary_file_name = file.name
+    os.replace(temporary_file_name, file_name)
+    return len(data)
+
+def read_shape_cache_file(file_name):
+    with open(file_name, 'rb') as file:
+        return file.read()
+
+def find_in_shape_cache(cache : ShapeCache, key):
+    # Returns (found, trimmed shape) since None is a valid trimmed shape
+    if key in cache.memory:
+        cache.memory.move_to_end(key)
+        cache.memory_hits += 1
+        return True, cache.memory[key]
+    if cache.directory is not None:
+        description_file_name = os.path.join(cache.directory, key + ".json")
+        try:
+            with open(description_file_name) as file:
+                description = json.load(file)
+            if description['kind'] == 'shape':
+                trimmed_shape = deserialize_shape_OCCT(read_shape_cache_file(os.path.join(cache.directory, key + ".brep")))
+            elif description['kind'] == 'planar_faces':
+                trimmed_shape = []
+                for face_index, fields in enumerate(description['planar_faces']):
+                    planar_face = PlanarFace()
+                    planar_face.face = deserialize_shape_OCCT(read_shape_cache_file(os.path.join(cache.directory, f"{key}.{face_index}.brep")))
+                    for name in PlanarFace.__slots__[1:]:
+                        setattr(planar_face, name, tuple(fields[name]) if isinstance(fields[name], list) else fields[name])
+                    trimmed_shape.append(planar_face)
+            else:
+                trimmed_shape = None
+            os.utime(description_file_name)
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            pass
+        else:
+            add_to_shape_cache_memory(cache, key, trimmed_shape)
+            cache.disk_hits += 1
+            return True, trimmed_shape
+    cache.misses += 1
+    return False, None
+
+def add_to_shape_cache(cache : ShapeCache, key, trimmed_shape):
+    # On disk an entry is the BRep text of its shape (or of each planar face) and a JSON description holding the kind of entry
+    # and the fields of the planar faces, written last so an entry is only found once its BRep files are complete
+    add_to_shape_cache_memory(cache, key, trimmed_shape)
+    if cache.directory is None:
+        return
+    description = {'kind': 'none'}
+    added_bytes = 0
+    if isinstance(trimmed_shape, list):
+        description = {'kind': 'planar_faces', 'planar_faces': []}
+        for face_index, planar_face in enumerate(trimmed_shape):
+            added_bytes += write_shape_cache_file(cache, os.path.join(cache.directory, f"{key}.{face_index}.brep"), serialize_shape_OCCT(planar_face.face))
+            description['planar_faces'].append({name: getattr(planar_face, name) for name in PlanarFace.__slots__[1:]})
+    elif trimmed_shape is not None:
+        description = {'kind': 'shape'}
+        added_bytes += write_shape_cache_file(cache, os.path.join(cache.directory, key + ".brep"), serialize_shape_OCCT(trimmed_shape))
+    added_bytes += write_shape_cache_file(cache, os.path.join(cache.directory, key + ".json"), json.dumps(description).encode('utf-8'))
+    update_shape_cache_disk_usage(cache, added_bytes)
+
+def trim_with_shape_cache(curve : Curve, primitives : list, cache : ShapeCache):
+    key = compute_shape_cache_key(curve, primitives)
+    found, trimmed_shape = find_in_shape_cache(cache, key)
+    if not found:
+        trimmed_shape = trim(curve, primitives)
+        add_to_shape_cache(cache, key, trimmed_shape)
+    return trimmed_shape
+
+def print_shape_cache_statistics(cache : ShapeCache):
+    print("Shape cache : memory hits", cache.memory_hits, "disk hits", cache.disk_hits, "misses", cache.misses, "disk bytes", cache.disk_bytes_used)
+
 # ===================================================
 # Utilities
 # ===================================================
 
+def make_curves_for_display_OCCT(edges, primitives : list, mode = CURVE_DISPLAY_MODE, classification = None):
+    # One shape per curve (or per segment in 'segments' mode), simplified to the err of its primitives plus ARITHMETIC_TOLERANCE
+    # classification is the result of classify_curves_and_build_topology used by trim_object, classified again when None
+    if mode == 'segments':
+        display_shapes = []
+        for curve in edges['curves']:
+            display_shapes.extend(make_curve_OCCT(curve['pv_points'], curve['pv_lines']))
+        return display_shapes
+    if classification is None:
+        classification = classify_curves_and_build_topology(edges, primitives)
+    curves_as_object, primitives_as_object, _ = classification
+    display_shapes = []
+    number_of_points = 0
+    number_of_kept_points = 0
+    for curve in curves_as_object:
+        if len(curve.points) < 2:
+            continue
+        find_start_end_of_curve(curve)
+        tolerance = ARITHMETIC_TOLERANCE + max([primitives_as_object[primitive_index].tolerance for primitive_index in curve.primitives], default=0.0)
+        points, is_curve_closed = simplify_curve(curve, tolerance)
+        number_of_points += len(curve.points)
+        number_of_kept_points += len(points)
+        if mode == 'bspline' and len(points) > 2:
+            display_shapes.append(make_bspline_edge_OCCT(points, is_curve_closed, tolerance))
+        else:
+            display_shapes.append(make_polygon_wire_OCCT(points, is_curve_closed and len(points) > 2))
+    if LOG_TO_CONSOLE:
+        print("Curves simplified from", number_of_points, "to", number_of_kept_points, "points")
+    return display_shapes
+
 def display_scene_OCCT(display_shapes, show_domain = False):
     if show_domain:
         domain = make_domain_OCCT()
@@ -524,31 +1978,790 @@ def read_data(surfaces_file, curves_file):
         exit(-1)
     return edges, primitives
 
-def save_to_step(shape : TopoDS_Compound):
+def compute_hash_of_files(*files):
+    hasher = hashlib.sha256()
+    for file_name in files:
+        with open(file_name, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+def write_binary_data(binary_file, edges, primitives, source_hash = ""):
+    # Layout : magic | header size (uint64) | header (JSON) | arrays aligned to BINARY_DATA_ALIGNMENT
+    # Arrays are one float64 buffer for all the points, one int32 buffer for all the (per curve) line indices,
+    # and the offsets of each curve into both buffers
+    curves = edges['curves']
+    point_counts = [len(curve['pv_points']) for curve in curves]
+    line_counts = [len(curve['pv_lines']) for curve in curves]
+    arrays = {
+        'points': np.concatenate([np.asarray(curve['pv_points'], dtype=np.float64).reshape(-1, 3) for curve in curves]) if curves else np.zeros((0, 3)),
+        'lines': np.concatenate([np.asarray(curve['pv_lines'], dtype=np.int32).reshape(-1, 2) for curve in curves]) if curves else np.zeros((0, 2), dtype=np.int32),
+        'point_offsets': np.concatenate([[0], np.cumsum(point_counts)]).astype(np.int64),
+        'line_offsets': np.concatenate([[0], np.cumsum(line_counts)]).astype(np.int64),
+        'corners': np.asarray(edges.get('corners', []), dtype=np.float64).reshape(-1, 3),
+    }
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = [array.dtype.str, list(array.shape), offset]
+        offset += -(-array.nbytes // BINARY_DATA_ALIGNMENT) * BINARY_DATA_ALIGNMENT
+    header = json.dumps({'source_hash': source_hash, 'arrays': layout, 'primitives': primitives}).encode('utf-8')
+    data_start = -(-(len(BINARY_DATA_MAGIC) + 8 + len(header)) // BINARY_DATA_ALIGNMENT) * BINARY_DATA_ALIGNMENT
+    # Written to a temporary file first so an interrupted write never leaves a file whose header matches the sources
+    with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(os.path.abspath(binary_file)), suffix=".tmp", delete=False) as file:
+        temporary_file_name = file.name
+        try:
+            file.write(BINARY_DATA_MAGIC)
+            file.write(struct.pack('<Q', len(header)))
+            file.write(header)
+            for name, array in arrays.items():
+                file.seek(data_start + layout[name][2])
+                file.write(np.ascontiguousarray(array).tobytes())
+            file.truncate(data_start + offset)
+        except BaseException:
+            file.close()
+            os.remove(temporary_file_name)
+            raise
+    os.replace(temporary_file_name, binary_file)
+
+def read_binary_header(binary_file):
+    with open(binary_file, 'rb') as file:
+        if file.read(len(BINARY_DATA_MAGIC)) != BINARY_DATA_MAGIC:
+            return None, 0
+        header_size, = struct.unpack('<Q', file.read(8))
+        header = json.loads(file.read(header_size).decode('utf-8'))
+    data_start = -(-(len(BINARY_DATA_MAGIC) + 8 + header_size) // BINARY_DATA_ALIGNMENT) * BINARY_DATA_ALIGNMENT
+    return header, data_start
+
+def read_binary_data(binary_file):
+    # The curves hold views into the memory mapped buffers, nothing is copied until it is used
+    header, data_start = read_binary_header(binary_file)
+    if header is None:
+        print("Error reading binary file", binary_file)
+        exit(-1)
+    arrays = {}
+    for name, (dtype, shape, offset) in header['arrays'].items():
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(binary_file, dtype=dtype, mode='r', offset=data_start + offset, shape=tuple(shape))
+    point_offsets = arrays['point_offsets']
+    line_offsets = arrays['line_offsets']
+    curves = []
+    for curve_index in range(len(point_offsets) - 1):
+        curves.append({
+            'pv_points': arrays['points'][point_offsets[curve_index]:point_offsets[curve_index + 1]],
+            'pv_lines': arrays['lines'][line_offsets[curve_index]:line_offsets[curve_index + 1]],
+        })
+    return {'curves': curves, 'corners': arrays['corners']}, header['primitives']
+
+def read_data_with_binary_cache(surfaces_file, curves_file, binary_file):
+    # Falls back to the JSON files when the binary file is missing or was built from other JSON files
+    if not (os.path.exists(surfaces_file) and os.path.exists(curves_file)):
+        if os.path.exists(binary_file):
+            return read_binary_data(binary_file)
+        return read_data(surfaces_file, curves_file)
+    source_hash = compute_hash_of_files(surfaces_file, curves_file)
+    if os.path.exists(binary_file):
+        header, _ = read_binary_header(binary_file)
+        if header is not None and header['source_hash'] == source_hash:
+            return read_binary_data(binary_file)
+        print("Binary file", binary_file, "is stale, rebuilding it")
+    edges, primitives = read_data(surfaces_file, curves_file)
+    write_binary_data(binary_file, edges, primitives, source_hash)
+    return read_binary_data(binary_file)
+
+def save_to_step(shape : TopoDS_Compound, file_name = "trimmed.step"):
+    from OCC.Core.STEPControl import STEPControl_Writer, STEPControl_AsIs
     writer = STEPControl_Writer()
-    writer.Transfer(shape, STEPControl_AsIs)
-    writer.Write("trimmed.step")
+    with instrument("STEPControl_Writer.Transfer", "occt"):
+        writer.Transfer(shape, STEPControl_AsIs)
+    with instrument("STEPControl_Writer.Write", "occt"):
+        writer.Write(file_name)
+
+def collect_components_of_shape_OCCT(shape):
+    if shape.ShapeType() != TopAbs_COMPOUND:
+        return [shape]
+    components = []
+    iterator = TopoDS_Iterator(shape)
+    while iterator.More():
+        components.append(iterator.Value())
+        iterator.Next()
+    return components
+
+def count_triangles_OCCT(shape):
+    number_of_triangles = 0
+    explorer = TopExp_Explorer(shape, TopAbs_FACE)
+    while explorer.More():
+        triangulation = BRep_Tool.Triangulation(topods.Face(explorer.Current()), TopLoc_Location())
+        if triangulation is not None:
+            number_of_triangles += triangulation.NbTriangles()
+        explorer.Next()
+    return number_of_triangles
 
-def save_to_stl(shape : TopoDS_Compound):
-    mesh = BRepMesh_IncrementalMesh(shape, 0.001)
-    mesh.Perform()
-    print("Saving file trimmed.stl")
+def make_levels_of_detail(values : list):
+    # values are presets of STL_LEVELS_OF_DETAIL for every component or component=preset (cube=fine cylinders=draft), returns the preset of every component
+    levels_of_detail = {component: STL_LEVEL_OF_DETAIL for component in STL_COMPONENTS}
+    for value in values:
+        component, _, level_of_detail = value.rpartition('=')
+        if level_of_detail not in STL_LEVELS_OF_DETAIL or (component != '' and component not in STL_COMPONENTS):
+            print("Unknown level of detail", value, "expected one of", *STL_LEVELS_OF_DETAIL, "optionally prefixed by one of", *STL_COMPONENTS, "and =")
+            exit(-1)
+        for other_component in (STL_COMPONENTS if component == '' else (component,)):
+            levels_of_detail[other_component] = level_of_detail
+    return levels_of_detail
+
+def find_level_of_detail(level_of_detail, component_name):
+    # level_of_detail is a preset for every component or the result of make_levels_of_detail
+    return level_of_detail.get(component_name, STL_LEVEL_OF_DETAIL) if isinstance(level_of_detail, dict) else level_of_detail
+
+def mesh_shape_OCCT(components : list, level_of_detail = STL_LEVEL_OF_DETAIL):
+    from OCC.Core.BRepMesh import BRepMesh_IncrementalMesh
+    # components are the (name, shape) of the result (the cube, the cylinders, see STL_COMPONENTS), every one gets the preset of its level
+    # of detail, relative presets scale the linear deflection by the diagonal of its bounding box, the faces are meshed in parallel by OCCT
+    start = time.perf_counter()
+    used_levels_of_detail = []
+    number_of_triangles = 0
+    for component_name, component in components:
+        if component is None:
+            continue
+        component_level_of_detail = find_level_of_detail(level_of_detail, component_name)
+        linear_deflection, angular_deflection, is_relative = STL_LEVELS_OF_DETAIL[component_level_of_detail]
+        if is_relative:
+            box = compute_bounding_box_OCCT(component)
+            if box.IsVoid():
+                continue
+            linear_deflection *= np.sqrt(box.SquareExtent())
+        with instrument("BRepMesh_IncrementalMesh", "occt", component=component_name, linear_deflection=linear_deflection, angular_deflection=angular_deflection):
+            BRepMesh_IncrementalMesh(component, linear_deflection, False, angular_deflection, True)
+        number_of_triangles += count_triangles_OCCT(component)
+        used_levels_of_detail.append(f"{component_name or 'shape'} {component_level_of_detail}")
+    meshing_time = time.perf_counter() - start
+    print(f"Meshed {number_of_triangles} triangles in {meshing_time:.3f}s ({', '.join(used_levels_of_detail)})")
+    return number_of_triangles, meshing_time
+
+def save_to_stl(shape : TopoDS_Compound, file_name = "trimmed.stl", level_of_detail = STL_LEVEL_OF_DETAIL, stl_format = STL_FORMAT, components = None):
+    # components are the (name, shape) that shape is made of (see trim_object), without them the whole shape gets the default preset
+    mesh_shape_OCCT(components if components is not None else [(None, shape)], level_of_detail)
+    write_stl_OCCT(shape, file_name, stl_format)
+
+def write_stl_OCCT(shape, file_name, stl_format = STL_FORMAT):
+    from OCC.Core.StlAPI import StlAPI_Writer
+    # The shape has to be meshed already
+    print("Saving file", file_name)
     writer = StlAPI_Writer()
-    writer.Write(shape, "trimmed.stl")
+    writer.SetASCIIMode(stl_format == 'ascii')
+    with instrument("StlAPI_Writer.Write", "occt"):
+        writer.Write(shape, file_name)
+
+# ===================================================
+# Incremental trimming
+# ===================================================
+
+def combine_incremental_keys(kind, keys : list):
+    return hashlib.sha256(repr((kind, keys)).encode('utf-8')).hexdigest()
+
+def reuse_or_compute_incremental(state : IncrementalState, kind, key, compute, *arguments):
+    if key in state.current:
+        return state.current[key]
+    if key in state.previous:
+        shape = state.previous[key]
+        state.reused[kind] = state.reused.get(kind, 0) + 1
+    else:
+        shape = compute(*arguments)
+        state.computed[kind] = state.computed.get(kind, 0) + 1
+    state.current[key] = shape
+    return shape
+
+def trim_curves_incremental(curves : list, primitives : list, state : IncrementalState, workers = 1, cache = None):
+    # Curves are keyed by their points, lines and primitives (see compute_shape_cache_key), only the keys unknown to the previous run are trimmed
+    keys = [compute_shape_cache_key(curve, primitives) for curve in curves]
+    changed_indices = [index for index, key in enumerate(keys) if key not in state.previous]
+    changed_shapes = trim_curves_with_primitive([curves[index] for index in changed_indices], primitives, workers, cache)
+    computed_shapes = {keys[index]: trimmed_shape for index, trimmed_shape in zip(changed_indices, changed_shapes)}
+    trimmed_shapes = []
+    for key in keys:
+        trimmed_shape = computed_shapes[key] if key in computed_shapes else state.previous[key]
+        state.current[key] = trimmed_shape
+        trimmed_shapes.append(trimmed_shape)
+    state.computed['curve'] = state.computed.get('curve', 0) + len(changed_indices)
+    state.reused['curve'] = state.reused.get('curve', 0) + len(keys) - len(changed_indices)
+    return trimmed_shapes, keys
+
+def fuse_bucket_incremental_OCCT(entries : list, depth, state : IncrementalState, glue = 'off'):
+    # entries are the (key, shape, tolerance) of a bucket sorted by key. A bucket larger than INCREMENTAL_FUSE_BUCKET_SIZE is split in
+    # 16 sub-buckets by the hexadecimal digit depth of the keys, which keep their position even when empty, so the pairs fused at
+    # every level only depend on the keys of the shapes below them and not on their position in the list
+    if len(entries) <= INCREMENTAL_FUSE_BUCKET_SIZE or depth >= len(entries[0][0]):
+        nodes = list(entries)
+    else:
+        sub_buckets = [[] for _ in range(16)]
+        for entry in entries:
+            sub_buckets[int(entry[0][depth], 16)].append(entry)
+        nodes = [fuse_bucket_incremental_OCCT(sub_bucket, depth + 1, state, glue) if len(sub_bucket) > 0 else None for sub_bucket in sub_buckets]
+    while len(nodes) > 1:
+        next_level = []
+        for index in range(0, len(nodes), 2):
+            node1 = nodes[index]
+            node2 = nodes[index + 1] if index + 1 < len(nodes) else None
+            if node1 is None or node2 is None:
+                next_level.append(node2 if node1 is None else node1)
+                continue
+            (key1, shape1, tolerance1), (key2, shape2, tolerance2) = node1, node2
+            key = combine_incremental_keys('fuse', [key1, key2])
+            options = make_boolean_options([tolerance1, tolerance2], glue)
+            next_level.append((key, reuse_or_compute_incremental(state, 'fuse', key, fuse_pair_OCCT, shape1, shape2, options), max(tolerance1, tolerance2)))
+        nodes = next_level
+    return nodes[0]
+
+def fuse_shapes_incremental_OCCT(shapes : list, keys : list, state : IncrementalState, tolerances : list, glue = 'off'):
+    # Pairwise reduction as fuse_shapes_tree_OCCT over buckets of the keys (see fuse_bucket_incremental_OCCT), every node is keyed by
+    # its children so adding, editing or removing a shape only re-fuses the nodes of its bucket and the ones above it
+    entries = sorted(((key, shape, tolerance) for key, shape, tolerance in zip(keys, shapes, tolerances) if shape is not None), key=lambda entry: entry[0])
+    if len(entries) == 0:
+        return None
+    return fuse_bucket_incremental_OCCT(entries, 0, state, glue)[1]
+
+def finish_incremental_run(state : IncrementalState):
+    # Only the shapes of this run are kept for the next one
+    for kind in ('curve', 'face_loop', 'fuse'):
+        print(f"Incremental {kind:10s} reused {state.reused.get(kind, 0):6d} computed {state.computed.get(kind, 0):6d}")
+    state.previous = state.current
+    discard_incremental_run(state)
+
+def discard_incremental_run(state : IncrementalState):
+    state.current = {}
+    state.reused = {}
+    state.computed = {}
+
+def compute_signature_of_files(*files):
+    try:
+        return tuple((os.stat(file_name).st_mtime_ns, os.stat(file_name).st_size) for file_name in files)
+    except FileNotFoundError:
+        return None
+
+def watch_model(surfaces_file, curves_file, run, interval = WATCH_INTERVAL):
+    # run(incremental) is called at start and every time the input files change, a change is taken once the files stopped changing for interval seconds
+    # A failing run is reported and the files are watched for the next change
+    incremental = IncrementalState()
+    signature = None
+    try:
+        while True:
+            current_signature = compute_signature_of_files(surfaces_file, curves_file)
+            if current_signature is not None and current_signature != signature:
+                time.sleep(interval)
+                if compute_signature_of_files(surfaces_file, curves_file) != current_signature:
+                    continue
+                signature = current_signature
+                start = time.perf_counter()
+                try:
+                    run(incremental)
+                    print(f"Trimmed in {time.perf_counter() - start:.3f}s, watching {surfaces_file} and {curves_file}")
+                except (SystemExit, Exception) as error:
+                    # An input file saved halfway or a failing stage (exit(-1)) only fails this run, the shapes of the last good run are kept
+                    discard_incremental_run(incremental)
+                    print(f"Trimming failed ({error!r}), watching {surfaces_file} and {curves_file}")
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+# ===================================================
+# Out-of-core assembly
+# ===================================================
+
+def split_curves_into_chunks(curves : list, primitives : list, chunk_curves = CHUNK_CURVES):
+    # Curves on the same primitives other than planes (the two circles of a cylinder) form a group that is never split, groups are sorted along
+    # the Z-order of the cells (1024 per axis) of their centers and packed into chunks of about chunk_curves curves
+    if len(curves) == 0:
+        return []
+    groups = {}
+    for curve in curves:
+        key = tuple(primitive_index for primitive_index in curve.primitives if not isinstance(primitives[primitive_index], Plane))
+        groups.setdefault(key or tuple(curve.primitives), []).append(curve)
+    groups = list(groups.values())
+    centers = np.array([np.mean([curve.points.mean(axis=0) for curve in group], axis=0) for group in groups])
+    lower = centers.min(axis=0)
+    extent = np.maximum(centers.max(axis=0) - lower, ARITHMETIC_TOLERANCE)
+    cells = np.minimum(((centers - lower) / extent * 1024.0).astype(np.int64), 1023)
+    codes = np.zeros(len(groups), dtype=np.int64)
+    for bit in range(10):
+        for axis in range(3):
+            codes |= ((cells[:, axis] >> bit) & 1) << (3 * bit + axis)
+    chunks = [[]]
+    for group_index in np.argsort(codes, kind='stable'):
+        if len(chunks[-1]) > 0 and len(chunks[-1]) + len(groups[group_index]) > chunk_curves:
+            chunks.append([])
+        chunks[-1].extend(groups[group_index])
+    return chunks
+
+def read_shape_OCCT(file_name):
+    shape = TopoDS_Shape()
+    breptools.Read(shape, file_name, BRep_Builder())
+    return shape
+
+def spill_chunk_OCCT(chunks : list, shape, name, directory):
+    if shape is None:
+        return
+    file_name = os.path.join(directory, name + ".brep")
+    with instrument("BRepTools.Write", "occt"):
+        breptools.Write(shape, file_name)
+    chunks.append((name, file_name))
+    peak_rss = measure_peak_rss()
+    print(f"Chunk {name} written to {file_name}" + ("" if peak_rss is None else f", peak RSS {peak_rss / (1 << 20):.1f} MB"))
+
+def trim_object_out_of_core(edges, primitives, directory, chunk_curves = CHUNK_CURVES, fuse_strategy = FUSE_STRATEGY, workers = 1, cache = None, classification = None):
+    # The cube and then spatial chunks of the other curves are trimmed and fused one at a time, every fused chunk is written
+    # to directory as BRep and released before the next one starts. Returns the (name, file) of the chunks
+    # Cylinders of different chunks are parts of the assembly, they are not fused with each other
+    os.makedirs(directory, exist_ok=True)
+    curves_as_object, primitives_as_object, topology = classification or classify_curves_and_build_topology(edges, primitives)
+    chunks = []
+    with instrument("trim_cube"):
+        face_loop_indices = sorted(topology.face_loop_curves)
+        face_loop_curves = [curves_as_object[curve_index] for curve_index in face_loop_indices]
+        trimmed_shapes = [None] * len(curves_as_object)
+        for curve_index, trimmed_shape in zip(face_loop_indices, trim_curves_with_primitive(face_loop_curves, primitives_as_object, workers, cache)):
+            trimmed_shapes[curve_index] = trimmed_shape
+        cube, _ = trim_cube(trimmed_shapes, topology, fuse_strategy)
+        del trimmed_shapes
+    spill_chunk_OCCT(chunks, cube, "cube", directory)
+    del cube
+    other_curves = [curve for curve_index, curve in enumerate(curves_as_object) if curve_index not in topology.face_loop_curves]
+    for chunk_index, chunk_curves_as_object in enumerate(split_curves_into_chunks(other_curves, primitives_as_object, chunk_curves)):
+        with instrument("trim_chunk", chunk=chunk_index, curves=len(chunk_curves_as_object)):
+            trimmed_shapes = trim_curves_with_primitive(chunk_curves_as_object, primitives_as_object, workers, cache)
+            is_kept = [is_trimmed_shape_of_cylinders(curve, trimmed_shape) for curve, trimmed_shape in zip(chunk_curves_as_object, trimmed_shapes)]
+            trimmed_shapes = [trimmed_shape for trimmed_shape, is_shape_kept in zip(trimmed_shapes, is_kept) if is_shape_kept]
+            tolerances = [compute_tolerance_of_curve(curve, primitives_as_object) for curve, is_shape_kept in zip(chunk_curves_as_object, is_kept) if is_shape_kept]
+            fused_chunk = fuse_shapes_OCCT(trimmed_shapes, fuse_strategy, tolerances)
+            del trimmed_shapes
+            spill_chunk_OCCT(chunks, fused_chunk, f"chunk_{chunk_index:04d}", directory)
+            del fused_chunk
+    return chunks
+
+def save_chunk_to_step_OCCT(name, chunk_file, step_file):
+    # Named part of a single chunk, the shape, document and writer are released on return
+    from OCC.Core.STEPCAFControl import STEPCAFControl_Writer
+    from OCC.Core.STEPControl import STEPControl_AsIs
+    from OCC.Core.TDocStd import TDocStd_Document
+    from OCC.Core.XCAFDoc import XCAFDoc_DocumentTool
+    from OCC.Core.TDataStd import TDataStd_Name
+    from OCC.Core.TCollection import TCollection_ExtendedString
+    document = TDocStd_Document("trimmed")
+    shape_tool = XCAFDoc_DocumentTool.ShapeTool(document.Main())
+    part = shape_tool.AddShape(read_shape_OCCT(chunk_file), False)
+    TDataStd_Name.Set(part, TCollection_ExtendedString(name))
+    writer = STEPCAFControl_Writer()
+    writer.SetNameMode(True)
+    with instrument("STEPCAFControl_Writer.Transfer", "occt", chunk=name):
+        writer.Transfer(document, STEPControl_AsIs)
+    with instrument("STEPCAFControl_Writer.Write", "occt", chunk=name):
+        writer.Write(step_file)
+
+def append_step_file(output, step_file, id_offset = 0, with_header = False):
+    # Copies the entities of the DATA section of step_file (and everything before it with with_header) to output, with their numbers
+    # shifted by id_offset outside of the strings. Returns the largest number written
+    maximum_id = id_offset
+    section = 'header'
+    is_in_string = False
+    def shift_id(match):
+        nonlocal maximum_id
+        entity_id = int(match.group(1)) + id_offset
+        maximum_id = max(maximum_id, entity_id)
+        return f"#{entity_id}"
+    with open(step_file) as file:
+        for line in file:
+            if section == 'header':
+                if with_header:
+                    output.write(line)
+                if line.strip() == "DATA;":
+                    section = 'data'
+            elif section == 'data':
+                if not is_in_string and line.strip() == "ENDSEC;":
+                    section = 'end'
+                    continue
+                parts = line.split("'")
+                for part_index in range(len(parts)):
+                    if not is_in_string:
+                        parts[part_index] = STEP_ENTITY_ID_PATTERN.sub(shift_id, parts[part_index])
+                    if part_index < len(parts) - 1:
+                        is_in_string = not is_in_string
+                output.write("'".join(parts))
+    return maximum_id
+
+def save_chunks_to_step_assembly(chunks : list, file_name = "trimmed.step"):
+    # One named part per chunk: every chunk is read back, written to a STEP file of its own and released before the next one,
+    # and the entities of the chunk files are appended to file_name, so only one chunk is in memory at a time
+    if len(chunks) == 0:
+        print("No chunk to save to", file_name)
+        return
+    print("Saving file", file_name)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(file_name))) as directory, open(file_name, 'w') as output:
+        id_offset = 0
+        for chunk_index, (name, chunk_file) in enumerate(chunks):
+            chunk_step_file = os.path.join(directory, name + ".step")
+            save_chunk_to_step_OCCT(name, chunk_file, chunk_step_file)
+            id_offset = append_step_file(output, chunk_step_file, id_offset, chunk_index == 0)
+            os.remove(chunk_step_file)
+            peak_rss = measure_peak_rss()
+            print(f"Chunk {name} added to {file_name}" + ("" if peak_rss is None else f", peak RSS {peak_rss / (1 << 20):.1f} MB"))
+        output.write("ENDSEC;\nEND-ISO-10303-21;\n")
+
+def save_chunks_to_stl(chunks : list, file_name = "trimmed.stl", level_of_detail = STL_LEVEL_OF_DETAIL, stl_format = STL_FORMAT):
+    # Every chunk is meshed and written on its own, then its triangles are appended to file_name
+    # (binary STL: the triangle count of the header is the sum of the counts of the chunks)
+    from OCC.Core.StlAPI import StlAPI_Writer
+    is_binary = (stl_format == 'binary')
+    number_of_triangles = 0
+    with tempfile.TemporaryDirectory() as directory, open(file_name, 'wb') as output:
+        if is_binary:
+            output.write(bytes(80) + struct.pack('<I', 0))
+        for name, chunk_file in chunks:
+            shape = read_shape_OCCT(chunk_file)
+            mesh_shape_OCCT([('cube' if name == 'cube' else 'cylinders', shape)], level_of_detail)
+            part_file = os.path.join(directory, name + ".stl")
+            writer = StlAPI_Writer()
+            writer.SetASCIIMode(not is_binary)
+            with instrument("StlAPI_Writer.Write", "occt"):
+                writer.Write(shape, part_file)
+            del shape
+            with open(part_file, 'rb') as part:
+                if is_binary:
+                    part.seek(80)
+                    number_of_triangles += struct.unpack('<I', part.read(4))[0]
+                shutil.copyfileobj(part, output)
+            os.remove(part_file)
+        if is_binary:
+            output.seek(80)
+            output.write(struct.pack('<I', number_of_triangles))
+    print("Saving file", file_name)
+
+# ===================================================
+# Export pipeline
+# ===================================================
+
+def start_export_pipeline(outputs : dict, level_of_detail = STL_LEVEL_OF_DETAIL, stl_format = STL_FORMAT):
+    # outputs maps each format of EXPORT_FORMATS to its file, every format is exported by its own process
+    # so the STEP transfer, the STL meshing and the trimming run at the same time
+    pipeline = ExportPipeline()
+    pipeline.outputs = outputs
+    pipeline.level_of_detail = level_of_detail
+    pipeline.stl_format = stl_format
+    for file_format in outputs:
+        pipeline.executors[file_format] = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context(PROCESS_START_METHOD))
+    return pipeline
+
+def export_component(pipeline : ExportPipeline, component, component_name):
+    # Called by trim_object with every component (cube, cylinders) as soon as it is fused
+    if component is None or len(pipeline.executors) == 0:
+        return
+    with instrument("serialize_shape_OCCT"):
+        serialized_component = serialize_shape_OCCT(component)
+    for file_format, executor in pipeline.executors.items():
+        pipeline.futures.append(executor.submit(add_component_in_export_worker, file_format, serialized_component, find_level_of_detail(pipeline.level_of_detail, component_name), component_name))
+
+def finish_export_pipeline(pipeline : ExportPipeline):
+    for file_format, executor in pipeline.executors.items():
+        pipeline.futures.append(executor.submit(write_in_export_worker, file_format, pipeline.outputs[file_format], pipeline.stl_format))
+    try:
+        for future in pipeline.futures:
+            future.result()
+    except Exception as error:
+        print("Export failed:", error)
+        exit(-1)
+    finally:
+        for executor in pipeline.executors.values():
+            executor.shutdown()
+
+# State of an export process, which handles the components of a single format one after the other
+export_worker_step_writer = None
+export_worker_components = []
+
+def add_component_in_export_worker(file_format, serialized_component : bytes, level_of_detail, component_name):
+    from OCC.Core.STEPControl import STEPControl_Writer, STEPControl_AsIs
+    global export_worker_step_writer
+    component = deserialize_shape_OCCT(serialized_component)
+    if file_format == 'step':
+        if export_worker_step_writer is None:
+            export_worker_step_writer = STEPControl_Writer()
+        export_worker_step_writer.Transfer(component, STEPControl_AsIs)
+    else:
+        mesh_shape_OCCT([(component_name, component)], level_of_detail)
+        export_worker_components.append(component)
+
+def write_in_export_worker(file_format, file_name, stl_format):
+    if file_format == 'step':
+        if export_worker_step_writer is None:
+            print("Nothing to save in", file_name)
+            return
+        print("Saving file", file_name)
+        export_worker_step_writer.Write(file_name)
+    else:
+        builder = BRep_Builder()
+        compound = TopoDS_Compound()
+        builder.MakeCompound(compound)
+        for component in export_worker_components:
+            builder.Add(compound, component)
+        write_stl_OCCT(compound, file_name, stl_format)
+
+# ===================================================
+# Batch processing
+# ===================================================
+
+def collect_batch_models(batch_input):
+    # Either a directory with one sub-directory per model (holding surface_info.json and topo.json)
+    # or a manifest with one JSON object per line {"name": ..., "surfaces": ..., "curves": ...}
+    models = []
+    if os.path.isdir(batch_input):
+        for name in sorted(os.listdir(batch_input)):
+            surfaces_file = os.path.join(batch_input, name, BATCH_SURFACES_FILE)
+            curves_file = os.path.join(batch_input, name, BATCH_CURVES_FILE)
+            if os.path.exists(surfaces_file) and os.path.exists(curves_file):
+                models.append({'name': name, 'surfaces': surfaces_file, 'curves': curves_file})
+    elif os.path.exists(batch_input):
+        manifest_directory = os.path.dirname(os.path.abspath(batch_input))
+        with open(batch_input) as file:
+            for line_number, line in enumerate(file, 1):
+                line = line.strip()
+                if len(line) == 0 or line.startswith('#'):
+                    continue
+                # A malformed line is a failed model, not the end of the batch
+                try:
+                    model = json.loads(line)
+                    model['surfaces'] = os.path.join(manifest_directory, model['surfaces'])
+                    model['curves'] = os.path.join(manifest_directory, model['curves'])
+                    model.setdefault('name', os.path.basename(os.path.dirname(model['curves'])))
+                    model['name'] = str(model['name'])
+                except (ValueError, KeyError, TypeError) as error:
+                    model = {'name': f"line_{line_number}", 'error': f"invalid manifest line {line_number}: {error!r}"}
+                models.append(model)
+    else:
+        print("Error reading batch input", batch_input)
+    # Every model has its own output directory, a name used twice gets the suffix _2, _3, ... in the order of the input
+    used_names = set()
+    for model in models:
+        name = model['name']
+        suffix = 2
+        while name in used_names:
+            name = f"{model['name']}_{suffix}"
+            suffix += 1
+        model['name'] = name
+        used_names.add(name)
+    return models
+
+def read_batch_summary(summary_file):
+    # Latest record of every model, a line that does not parse (the last one of a killed run) is skipped
+    records = {}
+    if os.path.exists(summary_file):
+        with open(summary_file) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(record, dict) and 'name' in record:
+                    records[record['name']] = record
+    return records
+
+def compute_hash_of_arguments(model_arguments):
+    return hashlib.sha256(json.dumps(model_arguments).encode('utf-8')).hexdigest()
+
+def compute_hash_of_outputs(output_directory):
+    outputs = {}
+    for file_name in BATCH_OUTPUT_FILES:
+        path = os.path.join(output_directory, file_name)
+        if not os.path.exists(path):
+            return None
+        outputs[file_name] = compute_hash_of_files(path)
+    return outputs
+
+def is_batch_model_unchanged(record, inputs_hash, arguments_hash, output_directory):
+    # The outputs of a model are kept when its inputs and the options it was run with are the same
+    if record is None or record.get('status') not in ('ok', 'skipped') or record.get('inputs_hash') != inputs_hash or record.get('arguments_hash') != arguments_hash:
+        return False
+    return compute_hash_of_outputs(output_directory) == record['outputs']
+
+def run_batch_model(model, output_directory, timeout, model_arguments):
+    # Every model runs in its own process so a crash, an exit(-1) or a timeout only affects that model
+    model_directory = os.path.join(output_directory, model['name'])
+    os.makedirs(model_directory, exist_ok=True)
+    command = [sys.executable, os.path.abspath(__file__), '--surfaces', model['surfaces'], '--curves', model['curves'], '--output-directory', model_directory, '--no-display'] + model_arguments
+    record = {'name': model['name'], 'inputs_hash': model['inputs_hash'], 'arguments_hash': compute_hash_of_arguments(model_arguments), 'outputs': None}
+    start = time.perf_counter()
+    with open(os.path.join(model_directory, "log.txt"), 'w') as log:
+        # The model runs in a session of its own, on timeout the whole process group is killed, with the trim and export workers of the model
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+        try:
+            process.communicate(timeout=timeout)
+            record['status'] = 'ok' if process.returncode == 0 else 'failed'
+            record['return_code'] = process.returncode
+        except subprocess.TimeoutExpired:
+            if hasattr(os, 'killpg'):
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+            process.communicate()
+            record['status'] = 'timeout'
+    record['seconds'] = time.perf_counter() - start
+    if record['status'] == 'ok':
+        record['outputs'] = compute_hash_of_outputs(model_directory)
+        if record['outputs'] is None:
+            record['status'] = 'failed'
+    return record
+
+def run_batch(batch_input, output_directory, jobs = 1, timeout = None, model_arguments = []):
+    os.makedirs(output_directory, exist_ok=True)
+    summary_file = os.path.join(output_directory, BATCH_SUMMARY_FILE)
+    previous_records = read_batch_summary(summary_file)
+    arguments_hash = compute_hash_of_arguments(model_arguments)
+    models = collect_batch_models(batch_input)
+    records = []
+    models_to_run = []
+    for model in models:
+        if 'error' in model:
+            records.append({'name': model['name'], 'status': 'failed', 'inputs_hash': None, 'outputs': None, 'seconds': 0.0, 'error': model['error']})
+            continue
+        if not (os.path.exists(model['surfaces']) and os.path.exists(model['curves'])):
+            records.append({'name': model['name'], 'status': 'failed', 'inputs_hash': None, 'outputs': None, 'seconds': 0.0, 'error': "missing input files"})
+            continue
+        model['inputs_hash'] = compute_hash_of_files(model['surfaces'], model['curves'])
+        previous_record = previous_records.get(model['name'])
+        if is_batch_model_unchanged(previous_record, model['inputs_hash'], arguments_hash, os.path.join(output_directory, model['name'])):
+            records.append({'name': model['name'], 'status': 'skipped', 'inputs_hash': model['inputs_hash'], 'arguments_hash': arguments_hash, 'outputs': previous_record['outputs'], 'seconds': 0.0})
+        else:
+            models_to_run.append(model)
+    with open(summary_file, 'a') as summary:
+        # A killed run can leave its last line without end, the next records start on a line of their own
+        if summary.tell() > 0:
+            with open(summary_file, 'rb') as file:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b"\n":
+                    summary.write("\n")
+        for record in records:
+            summary.write(json.dumps(record) + "\n")
+            print("Model", record['name'], record['status'])
+        summary.flush()
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            futures = [executor.submit(run_batch_model, model, output_directory, timeout, model_arguments) for model in models_to_run]
+            for future in as_completed(futures):
+                record = future.result()
+                records.append(record)
+                summary.write(json.dumps(record) + "\n")
+                summary.flush()
+                print("Model", record['name'], record['status'], f"({record['seconds']:.2f}s)")
+    return records
 
 # ===================================================
 # Entry point
 # ===================================================
 
+def trim_and_export_model(arguments, cache = None, incremental = None):
+    with instrument("read_data"):
+        if arguments.binary_cache is not None:
+            edges, primitives = read_data_with_binary_cache(arguments.surfaces, arguments.curves, arguments.binary_cache)
+        else:
+            edges, primitives = read_data(arguments.surfaces, arguments.curves)
+    if arguments.weld_tolerance > 0.0:
+        with instrument("weld_curves"):
+            edges = weld_curves(edges, arguments.weld_tolerance)
+    os.makedirs(arguments.output_directory, exist_ok=True)
+    # Classified once, for the trimming and for the curves shown with the result
+    classification = classify_curves_and_build_topology(edges, primitives)
+    outputs = \
+    {
+        'step': arguments.step_file or os.path.join(arguments.output_directory, "trimmed.step"),
+        'stl': arguments.stl_file or os.path.join(arguments.output_directory, "trimmed.stl"),
+    }
+    if arguments.low_memory:
+        with instrument("trim_object_out_of_core"):
+            chunks = trim_object_out_of_core(edges, primitives, os.path.join(arguments.output_directory, "chunks"), arguments.chunk_curves, arguments.fuse_strategy, arguments.workers, cache, classification)
+        if 'step' in arguments.export_formats:
+            with instrument("save_chunks_to_step_assembly"):
+                save_chunks_to_step_assembly(chunks, outputs['step'])
+        if 'stl' in arguments.export_formats:
+            with instrument("save_chunks_to_stl"):
+                save_chunks_to_stl(chunks, outputs['stl'], make_levels_of_detail(arguments.stl_level_of_detail), arguments.stl_format)
+        if cache is not None:
+            print_shape_cache_statistics(cache)
+        peak_rss = measure_peak_rss()
+        if peak_rss is not None:
+            print(f"Peak RSS {peak_rss / (1 << 20):.1f} MB")
+        return edges, primitives, classification, None
+    export_pipeline = start_export_pipeline({file_format: outputs[file_format] for file_format in arguments.export_formats}, make_levels_of_detail(arguments.stl_level_of_detail), arguments.stl_format)
+    try:
+        with instrument("trim_object"):
+            trimmed_object = trim_object(edges, primitives, arguments.fuse_strategy, arguments.workers, cache, lambda component, component_name: export_component(export_pipeline, component, component_name), incremental, classification)
+    except BaseException:
+        # The export processes would outlive a failed run of the watch mode
+        for executor in export_pipeline.executors.values():
+            executor.shutdown(cancel_futures=True)
+        raise
+    if cache is not None:
+        print_shape_cache_statistics(cache)
+    with instrument("finish_export_pipeline"):
+        finish_export_pipeline(export_pipeline)
+    return edges, primitives, classification, trimmed_object
+
 if __name__ == '__main__':
-    display_on_screen = True
-    edges, primitives = read_data("input_data/surface_info.json", "input_data/topo.json")
-    trimmed_object_from_primitives = trim_object(edges, primitives)
-    save_to_step(trimmed_object_from_primitives)
-    save_to_stl(trimmed_object_from_primitives)
-    if display_on_screen:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--surfaces', default="input_data/surface_info.json", help="JSON file with the primitives")
+    parser.add_argument('--curves', default="input_data/topo.json", help="JSON file with the curves")
+    parser.add_argument('--binary-cache', default=None, help="binary file used as cache of the JSON files (created or refreshed when stale)")
+    parser.add_argument('--workers', type=int, default=1, help="number of processes trimming the curves")
+    parser.add_argument('--fuse-strategy', default=FUSE_STRATEGY, choices=FUSE_STRATEGIES + ('compare',), help="how lists of shapes are fused, compare reports the timing of every strategy")
+    parser.add_argument('--cache-directory', default=None, help="directory of the on-disk cache of trimmed shapes")
+    parser.add_argument('--cache-size', type=int, default=SHAPE_CACHE_DISK_BYTES >> 20, help="size in MB of the on-disk cache of trimmed shapes")
+    parser.add_argument('--trace', default=None, help="Chrome trace-event JSON file with the timing of the stages, curves and OCCT operations")
+    parser.add_argument('--profile', action='store_true', help="print a summary table of the timing of the stages, curves and OCCT operations")
+    parser.add_argument('--output-directory', default=".", help="directory where trimmed.step and trimmed.stl are written")
+    parser.add_argument('--no-display', action='store_true', help="do not show the result on screen")
+    parser.add_argument('--export-formats', nargs='*', default=list(EXPORT_FORMATS), choices=EXPORT_FORMATS, help="formats written while trimming, each by its own process")
+    parser.add_argument('--step-file', default=None, help="path of the STEP file, trimmed.step in the output directory by default")
+    parser.add_argument('--stl-file', default=None, help="path of the STL file, trimmed.stl in the output directory by default")
+    parser.add_argument('--stl-format', default=STL_FORMAT, choices=STL_FORMATS)
+    parser.add_argument('--stl-level-of-detail', nargs='+', default=[STL_LEVEL_OF_DETAIL], help=f"meshing preset ({', '.join(STL_LEVELS_OF_DETAIL)}) of every component, or per component as cube=fine cylinders=draft")
+    parser.add_argument('--curve-display-mode', default=CURVE_DISPLAY_MODE, choices=CURVE_DISPLAY_MODES, help="one edge per segment, or one polygon wire or B-spline edge per simplified curve")
+    parser.add_argument('--watch', action='store_true', help="trim again every time the input files change, reusing the shapes of the curves, face loops and fuses that did not change")
+    parser.add_argument('--strict-booleans', action='store_true', help="run the booleans without the fuzzy value and glue derived from the err of the primitives")
+    parser.add_argument('--check-booleans', action='store_true', help="check every boolean result with BRepCheck_Analyzer and run invalid ones again in the strict mode")
+    parser.add_argument('--low-memory', action='store_true', help="trim and fuse the model in chunks written to disk, the STEP file has one part per chunk")
+    parser.add_argument('--chunk-curves', type=int, default=CHUNK_CURVES, help="number of curves of a chunk in low-memory mode")
+    parser.add_argument('--weld-tolerance', type=float, nargs='?', const=WELD_TOLERANCE, default=0.0, help="weld the points of the curves closer than this before trimming (WELD_TOLERANCE without value), off by default")
+    parser.add_argument('--batch', default=None, help="directory with one sub-directory per model or manifest with one JSON object per line")
+    parser.add_argument('--jobs', type=int, default=1, help="number of models trimmed at the same time in batch mode")
+    parser.add_argument('--timeout', type=float, default=None, help="seconds after which a model is stopped in batch mode")
+    arguments = parser.parse_args()
+    if arguments.batch is not None:
+        model_arguments = ['--workers', str(arguments.workers), '--fuse-strategy', arguments.fuse_strategy, '--stl-format', arguments.stl_format, '--stl-level-of-detail'] + arguments.stl_level_of_detail + ['--weld-tolerance', str(arguments.weld_tolerance)]
+        if arguments.strict_booleans:
+            model_arguments.append('--strict-booleans')
+        if arguments.check_booleans:
+            model_arguments.append('--check-booleans')
+        if arguments.low_memory:
+            model_arguments += ['--low-memory', '--chunk-curves', str(arguments.chunk_curves)]
+        if arguments.cache_directory is not None:
+            model_arguments += ['--cache-directory', os.path.abspath(arguments.cache_directory), '--cache-size', str(arguments.cache_size)]
+        records = run_batch(arguments.batch, arguments.output_directory, arguments.jobs, arguments.timeout, model_arguments)
+        sys.exit(0 if all(record['status'] in ('ok', 'skipped') for record in records) else 1)
+    display_on_screen = not arguments.no_display
+    boolean_fast_mode = not arguments.strict_booleans
+    boolean_check_validity = arguments.check_booleans
+    if arguments.trace is not None or arguments.profile:
+        enable_instrumentation()
+    cache = None
+    if arguments.cache_directory is not None:
+        # In low-memory mode the trimmed shapes are not kept in the memory LRU across chunks
+        cache = make_shape_cache(arguments.cache_directory, 0 if arguments.low_memory else SHAPE_CACHE_MEMORY_ENTRIES, arguments.cache_size << 20)
+    if arguments.watch:
+        watch_model(arguments.surfaces, arguments.curves, lambda incremental: trim_and_export_model(arguments, cache, incremental))
+    else:
+        edges, primitives, classification, trimmed_object_from_primitives = trim_and_export_model(arguments, cache)
+    if arguments.trace is not None:
+        export_instrumentation_to_chrome_trace(instrumentation, arguments.trace)
+    if arguments.profile:
+        print_instrumentation_summary(instrumentation)
+    if display_on_screen and not arguments.watch:
         display_shapes = []
         display_shapes.append(trimmed_object_from_primitives)
-        for curve in edges['curves']:
-            display_shapes.extend(make_curve_OCCT(curve['pv_points'], curve['pv_lines']))
+        display_shapes.extend(make_curves_for_display_OCCT(edges, primitives, arguments.curve_display_mode, classification))
         display_scene_OCCT(display_shapes)
\ No newline at end of file
@@ -0,0 +1,317 @@
+# Long-lived trimming service: a pool of processes with OCCT loaded trims the jobs posted on a localhost HTTP server
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import OrderedDict
+import urllib.parse
+import multiprocessing
+import importlib
+import threading
+import tempfile
+import argparse
+import hashlib
+import json
+import time
+import uuid
+import trim
+import os
+
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+SERVICE_WORKERS = 2
+# Jobs queued or running above which new jobs are refused with 503 (backpressure)
+SERVICE_MAXIMUM_PENDING_JOBS = 16
+# Parsed primitive sets and finished jobs kept in memory, least recently used first out
+SERVICE_PRIMITIVE_SETS = 64
+SERVICE_FINISHED_JOBS = 256
+SERVICE_FORMATS = ('step', 'stl', 'brep')
+# Imported by every worker when it starts, so that no job pays for them
+SERVICE_OCCT_MODULES = ('OCC.Core.BRepAlgoAPI', 'OCC.Core.BRepPrimAPI', 'OCC.Core.BRepOffsetAPI', 'OCC.Core.GC', 'OCC.Core.BRepMesh', 'OCC.Core.StlAPI', 'OCC.Core.STEPControl')
+
+class Job:
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = 'queued'
+        self.formats = []
+        self.submitted = time.time()
+        self.timing = {}
+        self.outputs = {}
+        self.error = None
+        self.done = threading.Event()
+
+class Service:
+    def __init__(self):
+        self.executor = None
+        self.workers = SERVICE_WORKERS
+        self.lock = threading.Lock()
+        self.primitive_sets = OrderedDict()
+        self.jobs = OrderedDict()
+        self.pending_jobs = 0
+        self.maximum_pending_jobs = SERVICE_MAXIMUM_PENDING_JOBS
+
+# ===================================================
+# Workers
+# ===================================================
+
+def initialize_service_worker():
+    for module in SERVICE_OCCT_MODULES:
+        importlib.import_module(module)
+
+def run_job_in_worker(edges, primitives_as_object : list, formats : list, options : dict):
+    # Returns the bytes of every format and the timing of every stage, started is the wall clock time the job left the queue
+    timing = {'started': time.time()}
+    if options['weld_tolerance'] > 0.0:
+        start = time.perf_counter()
+        edges = trim.weld_curves(edges, options['weld_tolerance'])
+        timing['weld'] = time.perf_counter() - start
+    start = time.perf_counter()
+    components = []
+    shape = trim.trim_object(edges, primitives_as_object, options['fuse_strategy'], on_component=lambda component, component_name: components.append((component_name, component)))
+    timing['trim'] = time.perf_counter() - start
+    outputs = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for file_format in formats:
+            start = time.perf_counter()
+            if file_format == 'brep':
+                outputs[file_format] = trim.serialize_shape_OCCT(shape)
+            else:
+                file_name = os.path.join(directory, "trimmed." + file_format)
+                if file_format == 'step':
+                    trim.save_to_step(shape, file_name)
+                else:
+                    trim.save_to_stl(shape, file_name, options['stl_level_of_detail'], options['stl_format'], components)
+                with open(file_name, 'rb') as file:
+                    outputs[file_format] = file.read()
+            timing[file_format] = time.perf_counter() - start
+    return outputs, timing
+
+# ===================================================
+# Service
+# ===================================================
+
+def start_service(workers = SERVICE_WORKERS, maximum_pending_jobs = SERVICE_MAXIMUM_PENDING_JOBS):
+    service = Service()
+    service.workers = workers
+    service.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(trim.PROCESS_START_METHOD), initializer=initialize_service_worker)
+    service.maximum_pending_jobs = maximum_pending_jobs
+    return service
+
+def restart_executor(service : Service, broken_executor):
+    # A worker that died (e.g. a crash inside OCCT) breaks the pool for good, the jobs it held fail and a new pool takes the next ones
+    with service.lock:
+        if service.executor is not broken_executor:
+            return
+        service.executor = ProcessPoolExecutor(max_workers=service.workers, mp_context=multiprocessing.get_context(trim.PROCESS_START_METHOD), initializer=initialize_service_worker)
+    broken_executor.shutdown(wait=False)
+
+def add_primitive_set(service : Service, primitives : list):
+    # Parsed once per content, the key is the hash of the canonical JSON of the primitives
+    key = hashlib.sha256(json.dumps(primitives, sort_keys=True).encode('utf-8')).hexdigest()
+    with service.lock:
+        if key in service.primitive_sets:
+            service.primitive_sets.move_to_end(key)
+            return key
+    primitives_as_object = trim.collect_primitives_as_objects(primitives)
+    with service.lock:
+        service.primitive_sets[key] = primitives_as_object
+        while len(service.primitive_sets) > SERVICE_PRIMITIVE_SETS:
+            service.primitive_sets.popitem(last=False)
+    return key
+
+def find_primitive_set(service : Service, key):
+    with service.lock:
+        primitives_as_object = service.primitive_sets.get(key)
+        if primitives_as_object is not None:
+            service.primitive_sets.move_to_end(key)
+        return primitives_as_object
+
+def read_json_file(file_name):
+    with open(file_name) as file:
+        return json.load(file)
+
+def submit_job(service : Service, request : dict):
+    # request holds the primitives ('primitives', 'primitives_hash' of a set already sent, or 'surfaces_file'), the curves
+    # ('curves' or 'curves_file'), the 'formats' to return and optionally 'fuse_strategy', 'stl_level_of_detail', 'stl_format' and
+    # 'weld_tolerance' (0, no welding, by default as in trim.py)
+    # Returns the HTTP status and the JSON answer, 503 when the pending jobs are at their maximum or the workers are being restarted
+    try:
+        if 'primitives_hash' in request:
+            primitives_hash = request['primitives_hash']
+        else:
+            primitives = request['primitives'] if 'primitives' in request else read_json_file(request['surfaces_file'])
+            if not isinstance(primitives, list):
+                return 400, {'error': "primitives have to be the list of surface_info.json"}
+            primitives_hash = add_primitive_set(service, primitives)
+        edges = request['curves'] if 'curves' in request else read_json_file(request['curves_file'])
+    except (KeyError, TypeError, OSError, ValueError) as error:
+        return 400, {'error': f"invalid request: {error!r}"}
+    if not isinstance(primitives_hash, str) or not isinstance(edges, dict):
+        return 400, {'error': "primitives_hash has to be a string and curves the object of topo.json"}
+    primitives_as_object = find_primitive_set(service, primitives_hash)
+    if primitives_as_object is None:
+        return 404, {'error': "unknown primitives_hash, send the primitives again", 'primitives_hash': primitives_hash}
+    formats = request.get('formats', ['step'])
+    if not isinstance(formats, list) or any(file_format not in SERVICE_FORMATS for file_format in formats):
+        return 400, {'error': f"formats have to be in {SERVICE_FORMATS}"}
+    options = \
+    {
+        'fuse_strategy': request.get('fuse_strategy', trim.FUSE_STRATEGY),
+        'stl_level_of_detail': request.get('stl_level_of_detail', trim.STL_LEVEL_OF_DETAIL),
+        'stl_format': request.get('stl_format', trim.STL_FORMAT),
+        'weld_tolerance': request.get('weld_tolerance', 0.0),
+    }
+    for option, choices in (('fuse_strategy', trim.FUSE_STRATEGIES), ('stl_level_of_detail', tuple(trim.STL_LEVELS_OF_DETAIL)), ('stl_format', trim.STL_FORMATS)):
+        if options[option] not in choices:
+            return 400, {'error': f"{option} has to be in {choices}"}
+    if not isinstance(options['weld_tolerance'], (int, float)) or options['weld_tolerance'] < 0.0:
+        return 400, {'error': "weld_tolerance has to be a number, 0 or more"}
+    job = Job()
+    job.formats = formats
+    with service.lock:
+        if service.pending_jobs >= service.maximum_pending_jobs:
+            return 503, {'error': "too many pending jobs", 'pending_jobs': service.pending_jobs}
+        service.pending_jobs += 1
+        service.jobs[job.id] = job
+        executor = service.executor
+    try:
+        future = executor.submit(run_job_in_worker, edges, primitives_as_object, formats, options)
+    except (BrokenProcessPool, RuntimeError) as error:
+        with service.lock:
+            service.pending_jobs -= 1
+            del service.jobs[job.id]
+        if isinstance(error, BrokenProcessPool):
+            restart_executor(service, executor)
+        return 503, {'error': f"workers unavailable, retry: {error!r}"}
+    future.add_done_callback(lambda future: finish_job(service, job, future, executor))
+    return 202, {'id': job.id, 'primitives_hash': primitives_hash}
+
+def finish_job(service : Service, job : Job, future, executor):
+    finished = time.time()
+    try:
+        job.outputs, worker_timing = future.result()
+        job.status = 'done'
+        job.timing['queued'] = worker_timing.pop('started') - job.submitted
+        job.timing.update(worker_timing)
+    except BaseException as error:
+        job.status = 'failed'
+        job.error = repr(error)
+        if isinstance(error, BrokenProcessPool):
+            restart_executor(service, executor)
+    job.timing['total'] = finished - job.submitted
+    with service.lock:
+        service.pending_jobs -= 1
+        finished_jobs = [job_id for job_id, other_job in service.jobs.items() if other_job.done.is_set()]
+        for job_id in finished_jobs[:max(0, len(finished_jobs) - SERVICE_FINISHED_JOBS + 1)]:
+            del service.jobs[job_id]
+    job.done.set()
+
+def describe_job(job : Job):
+    return {'id': job.id, 'status': job.status, 'error': job.error, 'timing': job.timing, 'outputs': {file_format: len(output) for file_format, output in job.outputs.items()}}
+
+# ===================================================
+# HTTP
+# ===================================================
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    # POST /primitives      body: surface_info.json, answer: {"primitives_hash"}
+    # POST /jobs            body: see submit_job, answer: 202 {"id"}, or 503 when the pending jobs are at their maximum
+    # GET  /jobs/ID[?wait]  status, timing (queued, trim, every format, total) and size of the outputs, wait blocks until the job is done
+    # GET  /jobs/ID/FORMAT  bytes of the output
+    # GET  /status          pending jobs and cached primitive sets
+    service = None
+
+    def send_json(self, status, answer):
+        body = json.dumps(answer).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 503:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        return json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+    def do_POST(self):
+        try:
+            request = self.read_json()
+        except ValueError as error:
+            self.send_json(400, {'error': f"invalid JSON: {error}"})
+            return
+        if self.path == '/primitives':
+            if not isinstance(request, list):
+                self.send_json(400, {'error': "expected the list of surface_info.json"})
+                return
+            try:
+                primitives_hash = add_primitive_set(self.service, request)
+            except (KeyError, TypeError, ValueError) as error:
+                self.send_json(400, {'error': f"invalid primitives: {error!r}"})
+                return
+            self.send_json(200, {'primitives_hash': primitives_hash})
+        elif self.path == '/jobs':
+            if not isinstance(request, dict):
+                self.send_json(400, {'error': "expected a JSON object"})
+                return
+            self.send_json(*submit_job(self.service, request))
+        else:
+            self.send_json(404, {'error': "unknown path"})
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if parts == ['status']:
+            with self.service.lock:
+                self.send_json(200, {'pending_jobs': self.service.pending_jobs, 'maximum_pending_jobs': self.service.maximum_pending_jobs, 'primitive_sets': len(self.service.primitive_sets)})
+            return
+        if len(parts) not in (2, 3) or parts[0] != 'jobs':
+            self.send_json(404, {'error': "unknown path"})
+            return
+        with self.service.lock:
+            job = self.service.jobs.get(parts[1])
+        if job is None:
+            self.send_json(404, {'error': "unknown job"})
+            return
+        if len(parts) == 2:
+            if 'wait' in urllib.parse.parse_qs(url.query, keep_blank_values=True):
+                job.done.wait()
+            self.send_json(200, describe_job(job))
+            return
+        file_format = parts[2]
+        if not job.done.is_set() or file_format not in job.outputs:
+            self.send_json(409 if not job.done.is_set() else 404, describe_job(job))
+            return
+        output = job.outputs[file_format]
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        for start in range(0, len(output), 1 << 20):
+            self.wfile.write(output[start:start + (1 << 20)])
+
+    def log_message(self, format, *arguments):
+        if trim.LOG_TO_CONSOLE:
+            super().log_message(format, *arguments)
+
+# ===================================================
+# Entry point
+# ===================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default=SERVICE_HOST)
+    parser.add_argument('--port', type=int, default=SERVICE_PORT)
+    parser.add_argument('--workers', type=int, default=SERVICE_WORKERS, help="number of processes trimming jobs at the same time")
+    parser.add_argument('--maximum-pending-jobs', type=int, default=SERVICE_MAXIMUM_PENDING_JOBS, help="jobs queued or running above which new jobs are refused")
+    arguments = parser.parse_args()
+    ServiceRequestHandler.service = start_service(arguments.workers, arguments.maximum_pending_jobs)
+    server = ThreadingHTTPServer((arguments.host, arguments.port), ServiceRequestHandler)
+    print(f"Trimming service on http://{arguments.host}:{arguments.port} with {arguments.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        ServiceRequestHandler.service.executor.shutdown()